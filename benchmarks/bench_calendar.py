@@ -0,0 +1,51 @@
+"""
+Microbenchmark of the calendar keyboard rendering.
+
+Compares rendering a month with the skeleton memoized (the normal case) and
+rebuilding it on every call, reporting time and allocations per render.
+
+    $ python benchmarks/bench_calendar.py
+"""
+import sys
+import timeit
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+import keyboards  # noqa: E402
+
+
+YEAR, MONTH = 2024, 5
+SELECTED = {1: 1, 2: 2, 7: 1, 8: 1, 14: 3, 15: 1, 21: 1, 22: 1, 28: 2}
+RENDERS = 10000
+
+
+def render_cold():
+    keyboards._calendar_skeleton.cache_clear()
+    keyboards._day_button.cache_clear()
+    keyboards.create_calendar(YEAR, MONTH, SELECTED)
+
+
+def render_warm():
+    keyboards.create_calendar(YEAR, MONTH, SELECTED)
+
+
+def peak_per_render(func) -> int:
+    func()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    for name, func in (('rebuilt', render_cold), ('memoized', render_warm)):
+        seconds = timeit.timeit(func, number=RENDERS)
+        print(f'{name:>9}: {seconds / RENDERS * 1e6:8.1f} us/render, '
+              f'{peak_per_render(func):7d} B peak/render')
+
+
+if __name__ == '__main__':
+    main()
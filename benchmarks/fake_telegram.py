@@ -0,0 +1,91 @@
+"""
+Stub Telegram client and synthetic events, enough to drive the handlers of
+`bot.py` without network.
+"""
+import asyncio
+import itertools
+from collections import Counter
+from pathlib import Path
+from typing import Optional
+
+
+_message_ids = itertools.count(1)
+
+
+class FakeUser:
+    def __init__(self, user_id: int, username: Optional[str], first_name: str = '', last_name: str = ''):
+        self.id = user_id
+        self.username = username
+        self.first_name = first_name
+        self.last_name = last_name
+
+
+class FakeClient:
+    """
+    Records what the handlers send instead of talking to Telegram.
+    """
+
+    def __init__(self):
+        self.users: dict[int, FakeUser] = {}
+        self.calls = Counter()
+        self.upload_bytes = 0
+        # seconds each edit takes
+        self.latency = 0.0
+
+    async def __call__(self, request):
+        self.calls[type(request).__name__] += 1
+
+    async def get_entity(self, user_id: int) -> FakeUser:
+        self.calls['get_entity'] += 1
+        return self.users[user_id]
+
+    def record(self, method: str, file=None):
+        self.calls[method] += 1
+        for path in file or []:
+            self.upload_bytes += Path(path).stat().st_size
+
+
+class FakeEvent:
+    """
+    Synthetic NewMessage or CallbackQuery event sent by `user`.
+    """
+
+    def __init__(
+        self,
+        client: FakeClient,
+        user: FakeUser,
+        text: str = '',
+        data: Optional[bytes] = None,
+        message_id: Optional[int] = None
+    ):
+        client.users.setdefault(user.id, user)
+        self.client = client
+        self.sender = user
+        self.sender_id = user.id
+        self.chat_id = user.id
+        self.id = next(_message_ids)
+        # message with the buttons of a callback query
+        self.message_id = message_id or self.id
+        self.raw_text = self.text = text
+        self.data = data
+        self.file = None
+
+    async def get_sender(self):
+        return self.sender
+
+    async def get_input_chat(self):
+        return self.sender
+
+    async def respond(self, *args, file=None, **kwargs):
+        self.client.record('respond', file)
+
+    async def reply(self, *args, file=None, **kwargs):
+        self.client.record('reply', file)
+
+    async def edit(self, *args, file=None, **kwargs):
+        self.client.record('edit', file)
+        # the round trip of the request
+        await asyncio.sleep(self.client.latency)
+
+    async def answer(self, *args, **kwargs):
+        self.client.record('answer')
@@ -0,0 +1,195 @@
+"""
+Offline load test of the bot handlers.
+
+Generates a `selected_days.csv` history of `--rows` rows in a temporary data
+directory, imports `bot.py` against it with a stub client and drives the
+calendar taps, the submits of calendar drafts, the current month calendar, the
+month picker callbacks and the crypto address flow with synthetic events. Reports p50/p99 latency and
+throughput per scenario, the startup time and the peak memory of the process.
+
+    $ python benchmarks/loadtest.py --rows 100000 --ops 2000 --backend csv
+
+Histories of 10k to 10M rows are supported, the generation of the biggest
+ones takes a while.
+"""
+import argparse
+import asyncio
+import csv
+import datetime
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from fake_telegram import FakeClient, FakeEvent, FakeUser  # noqa: E402
+
+
+COLUMNS = ['Year', 'Month', 'Day', 'Count', 'USERNAME', 'FIRST_NAME', 'LAST_NAME']
+MONTHS_OF_HISTORY = 24
+DAYS_PER_MONTH = 28
+
+
+def generate_history(path: Path, rows: int) -> int:
+    """
+    Writes `rows` attendance rows spread over tutors and the last months.
+
+    Returns:
+        The amount of tutors in the history.
+    """
+    today = datetime.date.today()
+    months = []
+    year, month = today.year, today.month
+    for _ in range(MONTHS_OF_HISTORY):
+        months.append((year, month))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+
+    per_tutor = MONTHS_OF_HISTORY * DAYS_PER_MONTH
+    tutors = max(1, -(-rows // per_tutor))
+    with open(path, mode='w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        written = 0
+        for tutor in range(tutors):
+            for year, month in months:
+                for day in range(1, DAYS_PER_MONTH + 1):
+                    if written == rows:
+                        return tutors
+                    writer.writerow([year, month, day, 1 + written % 3, f'tutor{tutor}', 'Tutor', str(tutor)])
+                    written += 1
+    return tutors
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def measure(name: str, make_call, ops: int, concurrency: int) -> dict:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await make_call(i)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(ops)))
+    elapsed = time.perf_counter() - start
+    return {
+        'scenario': name,
+        'ops': ops,
+        'p50_ms': percentile(latencies, 0.50) * 1e3,
+        'p99_ms': percentile(latencies, 0.99) * 1e3,
+        'ops_per_s': ops / elapsed,
+    }
+
+
+async def run(bot, ops: int, concurrency: int, tutors: int, latency: float = 0) -> list[dict]:
+    from telethon.events import StopPropagation
+
+    client = FakeClient()
+    client.latency = latency
+    users = [
+        FakeUser(1000 + i, f'tutor{i}', 'Tutor', str(i))
+        for i in range(min(tutors, max(1, concurrency * 4)))
+    ]
+
+    async def call(handler, event):
+        try:
+            await handler(event)
+        except StopPropagation:
+            pass
+
+    async def tap(i):
+        user = users[i % len(users)]
+        # every user taps on the same calendar message
+        await call(bot.callback_query_handler,
+                   FakeEvent(client, user, data=f'classes:{random.randint(1, 28)}'.encode(), message_id=user.id))
+
+    async def submit(i):
+        # a tap and the submit of the draft, in draft mode; two saved taps otherwise
+        user = users[i % len(users)]
+        for data in (f'classes:{random.randint(1, 28)}', 'classes:submit'):
+            await call(bot.callback_query_handler, FakeEvent(client, user, data=data.encode(), message_id=user.id))
+
+    async def current_month(i):
+        await call(bot.ShowCalendarCurrentMonth, FakeEvent(client, users[i % len(users)], '/classes_current_month'))
+
+    async def month_picker(i):
+        user = users[i % len(users)]
+        await call(bot.callback_query_handler, FakeEvent(client, user, data=b'select_month:month_5'))
+        await call(bot.callback_query_handler, FakeEvent(client, user, data=b'select_month:year_2024'))
+
+    async def crypto_address(i):
+        user = users[i % len(users)]
+        await call(bot.handle_crypto_address, FakeEvent(client, user, '/crypto_address'))
+        await call(bot.conversation_handler, FakeEvent(client, user, '0x' + f'{i:040x}'[-40:]))
+
+    results = []
+    for name, make_call in (
+        ('calendar tap', tap),
+        ('calendar draft submit', submit),
+        ('/classes_current_month', current_month),
+        ('month picker callbacks', month_picker),
+        ('crypto address flow', crypto_address),
+    ):
+        results.append(await measure(name, make_call, ops, concurrency))
+    results.append({'scenario': 'telegram calls', 'calls': dict(client.calls), 'upload_bytes': client.upload_bytes})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10_000, help='rows of the generated history')
+    parser.add_argument('--ops', type=int, default=1000, help='operations per scenario')
+    parser.add_argument('--concurrency', type=int, default=10, help='operations in flight')
+    parser.add_argument('--backend', default='csv', choices=['csv', 'sqlite'])
+    parser.add_argument('--latency', type=float, default=0, help='milliseconds each message edit takes')
+    parser.add_argument('--data-dir', type=Path, help='keep the data here instead of a temporary directory')
+    parser.add_argument('--calendar-mode', default='draft', choices=['draft', 'instant'])
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or Path(tempfile.mkdtemp(prefix='cointutor-bench-'))
+    data_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    tutors = generate_history(data_dir / 'selected_days.csv', args.rows)
+    print(f'generated {args.rows} rows for {tutors} tutors in {time.perf_counter() - start:.1f} s')
+
+    os.environ.update({
+        'API_ID': '1',
+        'API_HASH': 'bench',
+        'BOT_TOKEN': 'bench',
+        'USERNAME': str(data_dir / 'bench'),
+        'ADMIN_PASSWORD': 'bench',
+        'DATA_DIR': str(data_dir),
+        'STORAGE_BACKEND': args.backend,
+        'CALENDAR_MODE': args.calendar_mode,
+    })
+    start = time.perf_counter()
+    import bot
+    imported = time.perf_counter()
+    bot.create_app()
+    print(f'startup: import bot.py {imported - start:.2f} s, create_app {time.perf_counter() - imported:.2f} s')
+
+    results = asyncio.get_event_loop().run_until_complete(run(bot, args.ops, args.concurrency, tutors, args.latency / 1000))
+    for result in results:
+        if 'calls' in result:
+            print(f"{result['scenario']}: {result['calls']}, {result['upload_bytes']} bytes uploaded")
+        else:
+            print(f"{result['scenario']:>24}: p50 {result['p50_ms']:7.2f} ms, p99 {result['p99_ms']:7.2f} ms, "
+                  f"{result['ops_per_s']:8.1f} ops/s")
+
+    bot.attendance.close()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f'peak memory: {peak / 1024:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
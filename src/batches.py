@@ -0,0 +1,60 @@
+import json
+import os
+import threading
+from pathlib import Path
+from typing import Optional
+
+
+class BatchManifests:
+    """
+    Files each user sent after /add, persisted as one JSON manifest per user
+    so a batch being collected or zipped survives a restart.
+
+    A manifest holds the IDs of the messages with the files and, once /zip
+    was sent, the name of the zip being built.
+
+    Args:
+        directory: directory with the batches, one subdirectory per user.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self._lock = threading.Lock()
+
+    def root(self, user_id: int) -> Path:
+        """
+        Returns the directory with the downloads and the zip of a user.
+        """
+        return self.directory / str(user_id)
+
+    def _path(self, user_id: int) -> Path:
+        return self.root(user_id) / 'manifest.json'
+
+    def load_all(self) -> dict[int, dict]:
+        """
+        Returns the manifest of every user with a batch in progress.
+        """
+        manifests = {}
+        if not self.directory.is_dir():
+            return manifests
+        for path in self.directory.glob('*/manifest.json'):
+            try:
+                with open(path, encoding='utf-8') as file:
+                    manifests[int(path.parent.name)] = json.load(file)
+            except (ValueError, OSError):
+                continue
+        return manifests
+
+    def save(self, user_id: int, messages: list[int], zip_name: Optional[str] = None) -> None:
+        """
+        Atomically replaces the manifest of a user.
+        """
+        path = self._path(user_id)
+        with self._lock:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix('.tmp')
+            with open(tmp_path, mode='w', encoding='utf-8') as file:
+                json.dump({'messages': messages, 'zip': zip_name}, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp_path, path)
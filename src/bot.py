@@ -1,23 +1,36 @@
-import csv
 from functools import partial
-from asyncio import get_running_loop
+from asyncio import CancelledError, Task, get_running_loop, sleep
+from concurrent.futures import ThreadPoolExecutor
 from shutil import rmtree
+import tempfile
 from pathlib import Path
 import logging
 import os
+import signal
 import time
-from typing import Union, Optional
+from typing import Callable, Union, Optional
+from zipfile import ZipFile
 from dotenv import load_dotenv
 from telethon import TelegramClient, Button, events, types
+from telethon.errors import MessageNotModifiedError
 from telethon.events import NewMessage, StopPropagation
 from telethon.tl.custom import Message
 from telethon.tl.functions.messages import SendMessageRequest
 from telethon.tl.types import InputPeerUser, ReplyKeyboardForceReply
-import pandas as pd
 import datetime
 import calendar
 import re
-from utils import download_files, add_to_zip
+from utils import download_files, add_to_zip, media_path
+from batches import BatchManifests
+from exports import write_parts
+from storage import ADDRESS_COLUMNS, COLUMNS, connect, open_storage, tutor_key, WriteBehindAttendance
+from sessions import MemorySessions, SQLiteSessions
+from cache import LRUCache, Profile, ProfileCache
+from conversations import Conversations
+from drafts import MODES, Draft, Drafts
+from ratelimit import RateLimitedClient, RateLimiter
+import metrics
+from keyboards import calendar_text, create_calendar, month_markup, year_markup
 
 load_dotenv()
 
@@ -25,22 +38,73 @@ API_ID = int(os.environ['API_ID'])
 API_HASH = os.environ['API_HASH']
 BOT_TOKEN = os.environ['BOT_TOKEN']
 CONC_MAX = int(os.environ.get('CONC_MAX', 3))
+# downloads of a /zip grow from CONC_MAX up to this while the connection keeps up
+CONC_LIMIT = int(os.environ.get('CONC_LIMIT', 10))
+ZIP_MAX_MB = int(os.environ.get('ZIP_MAX_MB', 1950))
+IO_WORKERS = int(os.environ.get('IO_WORKERS', 4))
+# processes handling updates, sharded by user; more than one requires STORAGE_BACKEND=sqlite
+WORKERS = int(os.environ.get('WORKERS', 1))
 USERNAME = os.environ['USERNAME']
-STORAGE = Path('../data/')
-global_user_data = {}
+STORAGE = Path(os.environ.get('DATA_DIR', '../data/'))
 YEAR, MONTH = datetime.datetime.now().year, datetime.datetime.now().month
-FILENAME = "../data/selected_days.csv"
+FILENAME = str(STORAGE / 'selected_days.csv')
+ADDRESSES_FILENAME = str(STORAGE / 'crypto_addresses.csv')
+# 'csv' keeps the data in the CSV files, 'sqlite' in DATABASE
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'csv')
+DATABASE = os.environ.get('DATABASE', str(STORAGE / 'cointutor.db'))
 # FILENAME = 'selected_days.csv'
 ADMIN_PASSWORD = os.environ['ADMIN_PASSWORD']
-write_headers = not (os.path.exists(FILENAME) and os.path.getsize(FILENAME) > 0)
-columns = ['Year', 'Month', 'Day', 'Count', 'USERNAME', 'FIRST_NAME', 'LAST_NAME']
-if os.path.exists(FILENAME):
-    existing_data = pd.read_csv(FILENAME)
-else:
-    # Create the file   
-    existing_data = pd.DataFrame(columns=columns)
-    with open(FILENAME, 'w') as file:
-        existing_data.to_csv(file, index=False)
+COMPACT_EVERY = int(os.environ.get('COMPACT_EVERY', 1000))
+FLUSH_INTERVAL_MS = int(os.environ.get('FLUSH_INTERVAL_MS', 500))
+FLUSH_EVERY = int(os.environ.get('FLUSH_EVERY', 100))
+# metrics are served on http://METRICS_HOST:METRICS_PORT/metrics when the port is set
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+CALENDAR_CACHE_SIZE = int(os.environ.get('CALENDAR_CACHE_SIZE', 1024))
+PROFILE_TTL = float(os.environ.get('PROFILE_TTL', 3600))
+CONVERSATION_TIMEOUT = float(os.environ.get('CONVERSATION_TIMEOUT', 600))
+# seconds the selected month of a user is remembered since it was last used
+SESSION_TTL = float(os.environ.get('SESSION_TTL', 30 * 24 * 3600))
+SESSION_CAPACITY = int(os.environ.get('SESSION_CAPACITY', 100000))
+# seconds between saves of the selected months to disk (csv backend)
+SESSION_SNAPSHOT_INTERVAL = float(os.environ.get('SESSION_SNAPSHOT_INTERVAL', 60))
+# 'instant' saves every tap, 'draft' keeps the taps on a calendar until Submit is pressed
+CALENDAR_MODE = os.environ.get('CALENDAR_MODE', 'instant')
+# seconds the unsaved changes of a calendar are kept
+DRAFT_TIMEOUT = float(os.environ.get('DRAFT_TIMEOUT', 3600))
+# 'edit' updates the calendar message on every tap, 'upload' sends the CSV summary instead
+CALENDAR_REPLY_MODE = os.environ.get('CALENDAR_REPLY_MODE', 'edit')
+# messages per second (and in a row) sent to the same user and by the whole bot
+USER_RATE = float(os.environ.get('USER_RATE', 1))
+USER_BURST = float(os.environ.get('USER_BURST', 3))
+GLOBAL_RATE = float(os.environ.get('GLOBAL_RATE', 30))
+GLOBAL_BURST = float(os.environ.get('GLOBAL_BURST', 30))
+# longer FloodWaits are raised instead of waited
+MAX_FLOOD_WAIT = float(os.environ.get('MAX_FLOOD_WAIT', 60))
+# 'zip', 'gzip' or 'none', for the admin exports of /user_info
+EXPORT_COMPRESSION = os.environ.get('EXPORT_COMPRESSION', 'zip')
+# exports bigger than this are split, Telegram takes files up to 2 GB
+EXPORT_PART_MB = int(os.environ.get('EXPORT_PART_MB', 1950))
+
+# opened by create_app, so importing the handlers does no disk or network I/O
+attendance = addresses = sessions = None
+# (username, year, month) -> {day: count}, filled when rendering calendars
+calendar_cache = LRUCache(CALENDAR_CACHE_SIZE)
+profiles = ProfileCache(ttl=PROFILE_TTL)
+# replies the bot is waiting for, routed by conversation_handler
+conversations = Conversations(timeout=CONVERSATION_TIMEOUT)
+# unsaved changes of the calendars in draft mode
+drafts = Drafts(timeout=DRAFT_TIMEOUT)
+DRAFT_EXPIRED = ("Your unsaved changes on this calendar expired and were NOT saved. "
+                 "Please mark them again and press Submit.")
+
+# read from values kept up to date by the I/O pool, so scrapes never block the event loop
+metrics.Gauge('bot_attendance_rows', 'Rows of selected_days.', lambda: attendance.stored_rows if attendance else 0)
+metrics.Gauge('bot_attendance_pending', 'Buffered calendar taps.', lambda: attendance.pending() if attendance else 0)
+metrics.Gauge('bot_profile_cache_hits', 'Profile cache hits.', lambda: profiles.hits)
+metrics.Gauge('bot_profile_cache_misses', 'Profile cache misses.', lambda: profiles.misses)
+metrics.Gauge('bot_pending_conversations', 'Prompts waiting for a reply.', lambda: len(conversations))
+metrics.Gauge('bot_calendar_drafts', 'Calendars with unsaved changes.', lambda: len(drafts))
 
 MessageEvent = Union[NewMessage.Event, Message]
 # MessageEvent = NewMessage.Event | Message
@@ -55,9 +119,16 @@ logging.basicConfig(
 
 # dict to keep track of tasks for every user
 tasks: dict[int, list[int]] = {}
+# persisted copy of `tasks`, so batches survive restarts
+batches = BatchManifests(STORAGE / 'zips')
+# zips being built, by user
+zip_jobs: dict[int, Task] = {}
+# (user, calendar message) being updated -> arguments of the next update, if
+# more taps arrived meanwhile
+refreshing: dict[tuple[int, int], Optional[tuple]] = {}
 
-bot = TelegramClient(
-    USERNAME, api_id=API_ID, api_hash=API_HASH).start(bot_token=BOT_TOKEN)
+# thread pool where all blocking disk work runs, out of the event loop
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='storage')
 
 
 def is_valid_usdt_bep20_address(address):
@@ -81,30 +152,236 @@ def is_valid_usdt_bep20_address(address):
     return bool(re.match(pattern, address))
 
 
-@bot.on(NewMessage(pattern='/add'))
+async def run_io(func, *args, **kwargs):
+    """
+    Runs a blocking storage function in the I/O thread pool.
+
+    Returns:
+        The value returned by `func`.
+    """
+    with metrics.STORAGE_IO.time(operation=getattr(func, '__name__', 'call')):
+        return await get_running_loop().run_in_executor(io_executor, partial(func, *args, **kwargs))
+
+
+def record_upload(files: list) -> list:
+    """
+    Counts the bytes of the files about to be sent.
+
+    Returns:
+        The same files.
+    """
+    metrics.UPLOAD_BYTES.inc(sum(os.path.getsize(file) for file in files))
+    return files
+
+
+def parse_month_range(text: str):
+    """
+    Parses the `YYYY-MM [YYYY-MM]` arguments of the export commands.
+
+    Returns:
+        The first and last (year, month) of the range, in either order in
+        the text, both None without arguments, or None if the text is
+        malformed.
+    """
+    months = re.findall(r'(\d{4})-(\d{1,2})', text)
+    if len(months) > 2 or re.sub(r'\d{4}-\d{1,2}', '', text).strip():
+        return None
+    months = [(int(year), int(month)) for year, month in months]
+    if not all(1 <= month <= 12 for _, month in months):
+        return None
+    if not months:
+        return None, None
+    return min(months), max(months)
+
+
+def export_attendance(
+    directory: Path,
+    username: Optional[str] = None,
+    first=None,
+    last=None,
+    compression: str = 'none',
+    all_tutors: bool = False
+) -> list[Path]:
+    """
+    Streams the attendance rows of a tutor, keyed as in `tutor_of`, or of
+    every tutor with `all_tutors`, optionally between two months, into CSV
+    parts small enough to be uploaded.
+
+    Returns:
+        The paths of the written parts.
+    """
+    if all_tutors:
+        name = 'selected_days'
+    else:
+        name = f"{username.replace(':', '_')}_classes"
+    if first is not None:
+        name += f"_{first[0]}_{first[1]}" if first == last else f"_{first[0]}_{first[1]}-{last[0]}_{last[1]}"
+    return write_parts(name, COLUMNS, attendance.stream(username, first, last, all_tutors), directory,
+                       compression, EXPORT_PART_MB * 1024 * 1024)
+
+
+def export_addresses(directory: Path, username: Optional[str] = None, compression: str = 'none') -> list[Path]:
+    """
+    Streams the USDT addresses, optionally of one tutor, into CSV parts.
+    """
+    rows = (row for row in addresses.rows() if username is None or tutor_key(row[0], row[1]) == username)
+    return write_parts('crypto_addresses', ADDRESS_COLUMNS, rows, directory,
+                       compression, EXPORT_PART_MB * 1024 * 1024)
+
+
+async def send_files(event: MessageEvent, caption: str, files: list[Path]):
+    """
+    Replies with every file in its own message, numbering them when there
+    is more than one.
+    """
+    for number, file in enumerate(files, 1):
+        text = caption if len(files) == 1 else f"{caption} (part {number} of {len(files)})"
+        await event.reply(text, file=record_upload([file]))
+
+
+@events.register(NewMessage(pattern='/add'))
 async def start_task_handler(event: MessageEvent):
     """
     Notifies the bot that the user is going to send the media.
     """
+    if event.sender_id in zip_jobs:
+        await event.respond('Your zip is still being created, use /cancel to stop it.')
+        raise StopPropagation
+
     tasks[event.sender_id] = []
+    await run_io(batches.save, event.sender_id, [])
 
     await event.respond('OK, send me some files.')
 
     raise StopPropagation
 
 
-@bot.on(NewMessage(
-    func=lambda e: e.sender_id in tasks and e.file is not None))
+@events.register(NewMessage(
+    func=lambda e: e.sender_id in tasks and e.sender_id not in zip_jobs and e.file is not None))
 async def add_file_handler(event: MessageEvent):
     """
     Stores the ID of messages sended with files by this user.
     """
     tasks[event.sender_id].append(event.id)
+    await run_io(batches.save, event.sender_id, tasks[event.sender_id])
 
     raise StopPropagation
 
 
-@bot.on(NewMessage(pattern='/start'))
+@events.register(NewMessage(pattern=r'/zip\b(?: (?P<name>\w+))?'))
+async def zip_handler(event: MessageEvent):
+    """
+    Starts creating the zip with the files sent by this user.
+    """
+    if event.pattern_match['name'] is None:
+        await event.respond('Usage: /zip <name>, e.g. /zip summer_photos (letters, digits and _ only).')
+    elif event.sender_id not in tasks:
+        await event.respond('You must use /add first.')
+    elif not tasks[event.sender_id]:
+        await event.respond('You must send me some files first.')
+    elif event.sender_id in zip_jobs:
+        await event.respond('Your zip is already being created.')
+    else:
+        name = event.pattern_match['name']
+        await run_io(batches.save, event.sender_id, tasks[event.sender_id], name)
+        await event.respond('Creating the zip, it can take a while. Use /cancel to stop it.')
+        start_zip(event.client, event.sender_id, name)
+
+    raise StopPropagation
+
+
+@events.register(NewMessage(pattern='/cancel'))
+async def cancel_handler(event: MessageEvent):
+    """
+    Forgets the files sent by this user and stops the zip being created.
+    """
+    job = zip_jobs.pop(event.sender_id, None)
+    if job is not None:
+        job.cancel()
+    tasks.pop(event.sender_id, None)
+    await run_io(rmtree, batches.root(event.sender_id), ignore_errors=True)
+
+    await event.respond('Canceled zip. For a new one, use /add.')
+
+    raise StopPropagation
+
+
+def start_zip(client: TelegramClient, user_id: int, name: str) -> None:
+    zip_jobs[user_id] = get_running_loop().create_task(build_zip(client, user_id, name))
+
+
+def is_downloaded(root: Path, message: Message) -> bool:
+    path = media_path(root, message)
+    return path.is_file() and path.stat().st_size == message.file.size
+
+
+async def build_zip(client: TelegramClient, user_id: int, name: str):
+    """
+    Downloads the files of a batch and writes each one to a single open zip
+    as soon as it is downloaded, then sends the zip.
+
+    Downloads are kept until the zip is sent, so a batch resumed after a
+    restart only downloads the missing files.
+    """
+    root = batches.root(user_id)
+    files = root / 'files'
+    zip_path = root / f'{name}.zip'
+    try:
+        messages = await client.get_messages(user_id, ids=tasks[user_id])
+        messages = [m for m in messages if m is not None and m.file is not None]
+        if sum(m.file.size or 0 for m in messages) > ZIP_MAX_MB * 1024 * 1024:
+            await client.send_message(user_id, f"Total filesize must not exceed {ZIP_MAX_MB} MB.")
+        else:
+            downloaded = [m for m in messages if await run_io(is_downloaded, files, m)]
+            # by ID, comparing messages serializes both of them
+            downloaded_ids = {m.id for m in downloaded}
+            missing = [m for m in messages if m.id not in downloaded_ids]
+            names = set()
+
+            def arcname(m: Message) -> str:
+                arcname = media_path(files, m).name
+                if arcname in names:
+                    arcname = f'{m.id}_{arcname}'
+                names.add(arcname)
+                return arcname
+
+            zfile = await run_io(ZipFile, zip_path, 'w')
+            try:
+                for m in downloaded:
+                    await run_io(add_to_zip, zfile, media_path(files, m), arcname=arcname(m))
+                async for m, path in download_files(missing, CONC_MAX, files, CONC_LIMIT):
+                    await run_io(add_to_zip, zfile, path, arcname=arcname(m))
+            finally:
+                await run_io(zfile.close)
+            await client.send_file(user_id, record_upload([zip_path])[0], caption='Done!')
+    except CancelledError:
+        raise
+    except Exception:
+        logging.exception('Failed to create the zip of %d', user_id)
+        zip_jobs.pop(user_id, None)
+        await client.send_message(user_id, 'The zip could not be created, send /zip again to retry or /cancel.')
+        return
+
+    zip_jobs.pop(user_id, None)
+    tasks.pop(user_id, None)
+    await run_io(rmtree, root, ignore_errors=True)
+
+
+async def resume_batches(client: TelegramClient, owns: Callable[[int], bool] = lambda user_id: True):
+    """
+    Restarts the zips that were being created when the bot stopped.
+
+    Args:
+        client: connected client.
+        owns: tells whether a user is handled by this process.
+    """
+    for user_id, manifest in (await run_io(batches.load_all)).items():
+        if manifest.get('zip') and owns(user_id) and user_id not in zip_jobs:
+            logging.info('Resuming the zip of %d', user_id)
+            start_zip(client, user_id, manifest['zip'])
+
+
+@events.register(NewMessage(pattern='/start'))
 async def start_handler(event: MessageEvent):
     """
     Sends a welcome message to the user.
@@ -121,8 +398,19 @@ async def start_handler(event: MessageEvent):
     raise StopPropagation
 
 
-@bot.on(NewMessage(pattern='/help'))
-async def start_handler(event: MessageEvent):
+DRAFT_HELP = (
+    '✏️ Your taps on the calendar are saved when you press 💾 Submit. Use ➖ Remove to take back a class, '
+    '↔️ Range to add a class to several days at once, ↩️ Undo to revert your last tap and ❌ Discard to '
+    f'drop all the changes. Changes not submitted within {DRAFT_TIMEOUT / 60:.0f} minutes are lost. 🛠️\n\n'
+)
+INSTANT_HELP = (
+    '🚨 Every tap on a day of the calendar adds a class and is saved right away, so try to be careful when '
+    'selecting the days. 📆\n\n'
+)
+
+
+@events.register(NewMessage(pattern='/help'))
+async def help_handler(event: MessageEvent):
     """
     Sends a welcome message to the user.
     """
@@ -130,12 +418,12 @@ async def start_handler(event: MessageEvent):
         'You should update the calendar 📅 before the end of the month to indicate the classes you had that month. '
         'Try to do it after each class. The updates to calendar help us automate the payment process. 💸 \n\n '
         # 'We will give you an extra 1% bonus 💰 for calendar updates. '
-        '📈 After you add the classes, the system will send you an automatically generated csv file with'
-        ' the selected dates and the number of '
-        'classes you had each day. 📊 You can take a look to make sure everything is correct.👀\n\n'
+        '📈 After you add the classes, the calendar shows 🧑‍🏫 next to the selected dates and the number of '
+        'classes you had each day. 📊 Use /export to get an automatically generated csv file with them, '
+        'or /export 2024-01 2024-06 for several months. '
+        'You can take a look to make sure everything is correct.👀\n\n'
         
-        '🚨 Try to be careful when selecting the days. 📆 Command for removing accidental selections is under '
-        'development and will be added within a month. 🛠️\n\n'
+        + (DRAFT_HELP if CALENDAR_MODE == 'draft' else INSTANT_HELP) +
 
         'Thank you 😊'
 
@@ -144,25 +432,11 @@ async def start_handler(event: MessageEvent):
     raise StopPropagation
 
 
-@bot.on(NewMessage(pattern='/crypto_address'))
+@events.register(NewMessage(pattern='/crypto_address'))
 async def handle_crypto_address(event):
     user_id = event.sender_id
-    user_entity = await event.client.get_entity(user_id)
-    username = user_entity.username
-    first_name = user_entity.first_name
-    last_name = user_entity.last_name
-    current_address = None
-    flag_has_address = False
-    try:
-        with open('../data/crypto_addresses.csv', 'r') as file:
-            reader = csv.reader(file)
-            for row in reader:
-                if row[0] == str(user_id):
-                    current_address = row[4]
-                    flag_has_address = True
-                    break
-    except (FileNotFoundError, StopIteration):
-        current_address = None
+    username, first_name, last_name = await profiles.get(event)
+    current_address = await run_io(addresses.get, user_id)
 
     if current_address:
         message = f"✅ Current USDT Address (BEP20 network): {current_address}\n \n\n"
@@ -178,7 +452,7 @@ async def handle_crypto_address(event):
             link_preview=True
         )
         force_reply = ReplyKeyboardForceReply(single_use=True, selective=True)
-        await bot(SendMessageRequest(
+        await event.client(SendMessageRequest(
             peer=await event.get_input_chat(),
             message="💬 If you want to update your USDT address (BEP20 network), please reply to this message."
                     "  (include only the address):",
@@ -195,254 +469,420 @@ async def handle_crypto_address(event):
             link_preview=True
         )
         force_reply = ReplyKeyboardForceReply(single_use=True, selective=True)
-        await bot(SendMessageRequest(
+        await event.client(SendMessageRequest(
             peer=await event.get_input_chat(),
             message="💬 Please reply to this message with your USDT address (BEP20 network) (only the address):",
             reply_markup=force_reply,
         ))
 
-    @bot.on(NewMessage(from_users=event.sender_id, func=lambda e: e.text.strip().startswith('0x')))
     async def wait_for_reply(reply_event):
         new_address = reply_event.text.strip()
         if is_valid_usdt_bep20_address(new_address):
-            data_modified = False
-            try:
-                # Read all data from the CSV file
-                with open('../data/crypto_addresses.csv', 'r') as file:
-                    reader = csv.reader(file)
-                    data = list(reader)
-
-                # Check if user_id exists and update the address
-                for row in data:
-                    if row[0] == str(user_id):
-                        row[4] = new_address
-                        data_modified = True
-                        break
-
-                with open('../data/crypto_addresses.csv', 'w', newline='') as file:
-                    writer = csv.writer(file)
-                    writer.writerows(data)
-
-                if not data_modified:
-                    with open('../data/crypto_addresses.csv', 'a', newline='') as file:
-                        writer = csv.writer(file)
-                        writer.writerow([user_id, username,first_name, last_name, new_address])
-
-            except FileNotFoundError:
-                with open('../data/crypto_addresses.csv', 'w', newline='') as file:
-                    writer = csv.writer(file)
-                    writer.writerow(['USER_ID', 'USERNAME', 'FIRST_NAME', 'LAST_NAME', 'Address'])  # Optional: write headers
-                    writer.writerow([user_id, username, first_name, last_name, new_address])
+            await run_io(addresses.upsert, user_id, username, first_name, last_name, new_address)
             await reply_event.reply("Crypto address updated.")
         else:
             await reply_event.reply("Invalid address. Make sure you chose the correct <b>BEP20 network</b>."
                                     " Run the /crypto_address command to try again.", parse_mode='html')
-        bot.remove_event_handler(wait_for_reply)
+
+    conversations.expect(event, wait_for_reply, func=lambda e: (e.raw_text or '').strip().startswith('0x'))
 
 
-@bot.on(NewMessage(pattern='/user_info'))
+@events.register(NewMessage(pattern='/user_info'))
 async def handle_user_info_request(event: MessageEvent):
     """
-    Handle requests for user information.
+    Handle requests for user information, optionally of a month range and
+    a tutor, e.g. `/user_info 2024-01 2024-06 @tutor`, or `@id:<user ID>`
+    for a tutor without username.
     Starts by asking for a password.
     """
+    args = (event.raw_text or '').strip()[len('/user_info'):]
+    tutor = re.search(r'@((?:id:)?\w+)', args)
+    month_range = parse_month_range(re.sub(r'@(?:id:)?\w+', '', args))
+    if month_range is None:
+        await event.respond("Usage: /user_info [YYYY-MM [YYYY-MM]] [@tutor]")
+        return
+    first, last = month_range
+    username = tutor.group(1) if tutor else None
+
     force_reply = ReplyKeyboardForceReply(single_use=True, selective=True)
-    await bot(SendMessageRequest(
+    await event.client(SendMessageRequest(
         peer=await event.get_input_chat(),
         message="Please enter the admin password (it will take some time to send the files):",
         reply_markup=force_reply,
     ))
-    time.sleep(8)
 
-    @bot.on(NewMessage(from_users=event.sender_id))
     async def wait_for_password(reply_event):
-        if reply_event.text.strip() == ADMIN_PASSWORD:
+        if (reply_event.raw_text or '').strip() == ADMIN_PASSWORD:
             # Password correct, send user information
-            await send_user_info(reply_event)
+            await send_user_info(reply_event, username, first, last)
         else:
             await reply_event.reply("Incorrect password.")
-        bot.remove_event_handler(wait_for_password)
+
+    conversations.expect(event, wait_for_password)
 
 
-async def send_user_info(event: MessageEvent):
+async def send_user_info(event: MessageEvent, username: Optional[str] = None, first=None, last=None):
     """
-    Send 'selected_days.csv' and 'crypto_addresses.csv' files.
+    Send the rows of 'selected_days.csv' and 'crypto_addresses.csv', streamed
+    into compressed parts that fit in a Telegram upload.
     """
-    # Assuming the files are in the '../data/' directory
-    selected_days_file_path = "../data/selected_days.csv"
-    crypto_addresses_file_path = "../data/crypto_addresses.csv"
+    directory = Path(await run_io(tempfile.mkdtemp, prefix='export-', dir=STORAGE))
+    try:
+        days_files = await run_io(export_attendance, directory, username, first, last, EXPORT_COMPRESSION,
+                                  all_tutors=username is None)
+        address_files = await run_io(export_addresses, directory, username, EXPORT_COMPRESSION)
+        await send_files(event, "Sending 'selected_days.csv'", days_files)
+        await send_files(event, "Sending 'crypto_addresses.csv'", address_files)
+    finally:
+        await run_io(rmtree, directory, ignore_errors=True)
+
 
-    # Check if files exist
-    if not os.path.exists(selected_days_file_path) or not os.path.exists(crypto_addresses_file_path):
-        await event.reply("Error: One or both files do not exist.")
+@events.register(NewMessage(pattern='/payroll'))
+async def handle_payroll_request(event: MessageEvent):
+    """
+    Handle requests for the payroll of a month, e.g. `/payroll 2024-05`.
+    Starts by asking for a password.
+    """
+    match = re.fullmatch(r'/payroll(?:\s+(\d{4})-(\d{1,2}))?', (event.raw_text or '').strip())
+    if match is None or (match.group(2) and not 1 <= int(match.group(2)) <= 12):
+        await event.respond("Usage: /payroll YYYY-MM")
         return
+    if match.group(1):
+        year, month = int(match.group(1)), int(match.group(2))
+    else:
+        year, month = datetime.datetime.now().year, datetime.datetime.now().month
+
+    force_reply = ReplyKeyboardForceReply(single_use=True, selective=True)
+    await event.client(SendMessageRequest(
+        peer=await event.get_input_chat(),
+        message="Please enter the admin password:",
+        reply_markup=force_reply,
+    ))
+
+    async def wait_for_password(reply_event):
+        if (reply_event.raw_text or '').strip() == ADMIN_PASSWORD:
+            await send_payroll(reply_event, year, month)
+        else:
+            await reply_event.reply("Incorrect password.")
+
+    conversations.expect(event, wait_for_password)
+
 
-    # Send the files
-    await event.reply("Sending 'selected_days.csv' and 'crypto_addresses.csv' files.",
-                      file=[selected_days_file_path, crypto_addresses_file_path])
-
-
-def selected_days_from_csv(year: str, month: str, username: str):
-    df = pd.read_csv(FILENAME)
-    filtered_df = df[(df['Year'] == year) & (df['Month'] == month) & (df['USERNAME'] == username)]
-    filtered = filtered_df.values.tolist()
-    selected_days = list()
-    for i in range(len(filtered)):
-        selected_days.append(int(filtered[i][2]))
-    selected_days.sort()
-    selected_days = set(selected_days)
-    return list(selected_days)
-
-
-def create_calendar(year, month, selected_days):
-    markup = []
-    week_days = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
-    # Select a Different Month button
-    markup.append([Button.inline("Select a Different Month", data="classes:selecting_month")])
-    # Weekdays header
-    markup += [[Button.inline(day, data="ignore") for day in week_days]]
-    # Calendar days
-    cal_month = calendar.monthcalendar(year, month)
-    for week in cal_month:
-        row = []
-        for day in week:
-            if day == 0:
-                row.append(Button.inline(" ", data="ignore"))
-                continue
-            text = f"{day}🧑‍🏫" if day in selected_days else str(day)
-            row.append(Button.inline(text, data=f"classes:{day}" if day != 0 else "ignore"))
-        markup.append(row)
-    # Submit button
-    # markup.append([Button.inline("Submit", data="classes:submit")])
-    return markup
-
-
-@bot.on(NewMessage(pattern='/selected_month_calendar'))
+async def send_payroll(event: MessageEvent, year: int, month: int):
+    """
+    Send the classes, active days and USDT address of every tutor in a month.
+    """
+    totals = await run_io(attendance.month_totals, year, month)
+    payout_addresses = await run_io(addresses.by_username)
+
+    lines = [f"Payroll for {calendar.month_name[month]} {year}:", ""]
+    for total in totals:
+        name = ' '.join(filter(None, [total.first_name, total.last_name]))
+        address = payout_addresses.get(total.username, 'no USDT address')
+        if total.username.startswith('id:'):
+            tutor = f"{name or 'Tutor'} (no username, ID {total.username[len('id:'):]})"
+        elif total.username:
+            tutor = f"@{total.username} ({name})"
+        else:
+            # classes stored before tutors without username were told apart
+            tutor = f"Tutors without username ({name})"
+        lines.append(f"{tutor}: {total.classes} classes, {total.days} days, {address}")
+    lines.append("")
+    lines.append(f"Total: {sum(t.classes for t in totals)} classes by {len(totals)} tutors.")
+
+    for chunk in split_message(lines):
+        await event.reply(chunk)
+
+
+def split_message(lines: list[str], limit: int = 4096) -> list[str]:
+    """
+    Joins lines into messages no longer than Telegram's limit.
+    """
+    chunks, current = [], ''
+    for line in lines:
+        if current and len(current) + len(line) + 1 > limit:
+            chunks.append(current)
+            current = ''
+        current = f"{current}\n{line}" if current else line
+    chunks.append(current or '-')
+    return chunks
+
+
+async def tutor_of(event) -> Profile:
+    """
+    Returns the profile of the sender of an event with the username their
+    classes are stored under, see `storage.tutor_key`.
+    """
+    profile = await profiles.get(event)
+    return profile._replace(username=tutor_key(event.sender_id, profile.username))
+
+
+async def selected_day_counts(username, year: int, month: int) -> dict[int, int]:
+    """
+    Returns the amount of classes per day of a tutor in the given month,
+    reading the storage only on a cache miss.
+    """
+    key = (username or '', year, month)
+    counts = calendar_cache.get(key)
+    if counts is None:
+        generation = calendar_cache.generation
+        counts = await run_io(attendance.day_counts, username, year, month)
+        calendar_cache.put(key, counts, generation)
+    return counts
+
+
+@events.register(NewMessage(pattern='/selected_month_calendar'))
 async def ShowCalendar(event):
-    user = await event.client.get_entity(event.sender_id)
-    username = user.username
+    username = (await tutor_of(event)).username
 
-    year = global_user_data[event.sender_id]['selected_year']
-    month = global_user_data[event.sender_id]['selected_month']
+    user_data = await run_io(sessions.get, event.sender_id)
+    if 'selected_year' not in user_data or 'selected_month' not in user_data:
+        await event.respond("Please select a month first with /select_month.")
+        return
+    year = user_data['selected_year']
+    month = user_data['selected_month']
 
     # Filter data for the current user and month
-    selected_days = selected_days_from_csv(str(year), str(month), str(username))
+    selected_days = await selected_day_counts(username, year, month)
 
     # Creating and sending the calendar
-    calendar_markup = create_calendar(year, month, selected_days)
-    await event.respond(f"Please select the days in {calendar.month_name[month]} {year} when you had classes:",
-                        buttons=calendar_markup)
+    buttons = calendar_markup(event.sender_id, None, year, month, selected_days)
+    await event.respond(calendar_text(year, month, CALENDAR_MODE == 'draft'), buttons=buttons)
 
 
-@bot.on(NewMessage(pattern='/classes_current_month'))
+@events.register(NewMessage(pattern='/classes_current_month'))
 async def ShowCalendarCurrentMonth(event):
-    user = await event.client.get_entity(event.sender_id)
-    username = user.username
+    username = (await tutor_of(event)).username
     # Get the current year and month
     year, month = datetime.datetime.now().year, datetime.datetime.now().month
-    user_id = event.sender_id
-    # Accessing or initializing user data
-    if user_id not in global_user_data:
-        global_user_data[user_id] = {}
-    global_user_data[event.sender_id]['selected_year'] = year
-    global_user_data[event.sender_id]['selected_month'] = month
+    await run_io(sessions.update, event.sender_id, selected_year=year, selected_month=month)
     # Filter data for the current user and month
-    selected_days = selected_days_from_csv(str(year), str(month), str(username))
+    selected_days = await selected_day_counts(username, year, month)
     # Creating and sending the calendar
-    calendar_markup = create_calendar(year, month, selected_days)
-    await event.respond(f"Please select the days in {calendar.month_name[month]} {year} when you had classes:",
-                        buttons=calendar_markup)
+    buttons = calendar_markup(event.sender_id, None, year, month, selected_days)
+    await event.respond(calendar_text(year, month, CALENDAR_MODE == 'draft'), buttons=buttons)
 
 
-@bot.on(events.NewMessage(pattern='/select_month'))
-async def select_month(event):
-    months = [calendar.month_abbr[i] for i in range(1, 13)]
-    month_buttons = [Button.inline(month, f"select_month:month_{i}") for i, month in enumerate(months, 1)]
+@events.register(NewMessage(pattern='/export'))
+async def export_classes(event):
+    """
+    Sends the CSV summary of the classes of the selected month, or of a
+    month range, e.g. `/export 2024-01 2024-06`.
+    """
+    month_range = parse_month_range((event.raw_text or '').strip()[len('/export'):])
+    if month_range is None:
+        await event.respond("Usage: /export [YYYY-MM [YYYY-MM]]")
+        return
+    username = (await tutor_of(event)).username
+    first, last = month_range
+    if first is None:
+        user_data = await run_io(sessions.get, event.sender_id)
+        first = last = (user_data.get('selected_year', datetime.datetime.now().year),
+                        user_data.get('selected_month', datetime.datetime.now().month))
+    if first == last:
+        caption = f"Your classes for {calendar.month_name[first[1]]} {first[0]}."
+    else:
+        caption = (f"Your classes from {calendar.month_name[first[1]]} {first[0]} "
+                   f"to {calendar.month_name[last[1]]} {last[0]}.")
+
+    directory = Path(await run_io(tempfile.mkdtemp, prefix='export-', dir=STORAGE))
+    try:
+        files = await run_io(export_attendance, directory, username, first, last)
+        await send_files(event, caption, files)
+    finally:
+        await run_io(rmtree, directory, ignore_errors=True)
 
-    # Grouping buttons in rows of three
-    month_markup = [month_buttons[i:i + 3] for i in range(0, len(month_buttons), 3)]
-    # month_markup.append([Button.inline("Submit", "select_month:submit")])
 
-    await event.respond('Please select the month you want to make changes to:', buttons=month_markup)
+@events.register(NewMessage(pattern='/select_month'))
+async def select_month(event):
+    await event.respond('Please select the month you want to make changes to:', buttons=month_markup())
 
 
 async def select_year(event):
     current_year = datetime.datetime.now().year
-    year_buttons = [Button.inline(str(year), f"select_month:year_{year}") for year in range(current_year - 5, current_year + 6)]
-
-    # Grouping buttons in rows of three
-    year_markup = [year_buttons[i:i+3] for i in range(0, len(year_buttons), 3)]
-    # year_markup.append([Button.inline("Submit", "select_month:submit")])
-
-    await event.respond('Please select the year you want to make changes to:', buttons=year_markup)
+    await event.respond('Please select the year you want to make changes to:', buttons=year_markup(current_year))
 
 
 async def handle_selection_classes(event):
     # Extracting callback data
-    data_formatted = event.data.decode('utf-8').split(':')[1]
-    day_selected = data_formatted
-    print(day_selected)
+    data_formatted = event.data.decode('utf-8').split(':')
+    day_selected = data_formatted[1]
+    # the calendar showed unsaved changes
+    pending = data_formatted[2:] == ['pending']
     if day_selected == "ignore":
         return
+    if day_selected == "selecting_month":
+        await select_month(event)
+        return
+    if CALENDAR_MODE == 'draft':
+        await edit_draft(event, day_selected, pending)
+        return
+    if pending or not day_selected.isdigit():
+        # a button of draft mode on an old calendar
+        if pending:
+            await event.answer("The unsaved changes on this calendar were NOT saved. "
+                               "Please open the calendar again.", alert=True)
+        else:
+            await event.answer("Please open the calendar again.")
+        return
+    username, first_name, last_name = await tutor_of(event)
+    year, month = await selected_month_of(event.sender_id)
+
+    await run_io(attendance.increment, username, first_name, last_name, year, month, int(day_selected))
+    calendar_cache.invalidate((username or '', year, month))
+
+    if CALENDAR_REPLY_MODE != 'upload':
+        selected_days = await selected_day_counts(username, year, month)
+        await event.answer(f"Saved {selected_days.get(int(day_selected), 0)} class(es) on day {day_selected}.")
+    await refresh_calendar(event, username, year, month)
+
+
+async def selected_month_of(user_id: int) -> tuple[int, int]:
+    """
+    Returns the year and month selected by a user, selecting the current
+    ones if the user has not picked any.
+    """
+    user_data = await run_io(sessions.get, user_id)
+    if 'selected_year' not in user_data or 'selected_month' not in user_data:
+        user_data = await run_io(
+            sessions.update, user_id,
+            selected_year=user_data.get('selected_year', datetime.datetime.now().year),
+            selected_month=user_data.get('selected_month', datetime.datetime.now().month),
+        )
+    return int(user_data['selected_year']), int(user_data['selected_month'])
+
+
+async def edit_draft(event, action: str, pending: bool = False):
+    """
+    Applies a tap on a calendar in draft mode: days and ranges are added to
+    or removed from the draft of the message, which is only saved, in a
+    single transaction, on submit.
+
+    A tap on a calendar that showed unsaved changes whose draft is gone,
+    because it expired or the bot restarted, only tells the user so and
+    shows the saved classes again.
+    """
     user_id = event.sender_id
-    user_entity = await event.client.get_entity(user_id)
-    username = user_entity.username
-    first_name = user_entity.first_name
-    last_name = user_entity.last_name
-
-    # Accessing or initializing user data
-    if user_id not in global_user_data:
-        global_user_data[user_id] = {}
-    user_data = global_user_data[user_id]
-
-    # Retrieve or set the selected year and month
-    user_data['selected_year'] = user_data.get('selected_year', datetime.datetime.now().year)
-    user_data['selected_month'] = user_data.get('selected_month', datetime.datetime.now().month)
-    year, month = str(user_data['selected_year']), str(user_data['selected_month'])
-
-    if os.path.exists(FILENAME) and os.path.getsize(FILENAME) > 0:
-        with open(FILENAME, mode='r', encoding='utf-8') as file:
-            reader = csv.DictReader(file)
-            data = list(reader)
+    username = (await tutor_of(event)).username
+    draft = drafts.get(user_id, event.message_id)
+    if draft is None and pending:
+        await event.answer(DRAFT_EXPIRED, alert=True)
+        year, month = await selected_month_of(user_id)
+        await refresh_calendar(event, username, year, month)
+        return
+    if draft is None:
+        year, month = await selected_month_of(user_id)
+        draft = drafts.open(user_id, event.message_id, year, month)
+    else:
+        drafts.open(user_id, event.message_id, draft.year, draft.month)
+    year, month = draft.year, draft.month
+
+    if action == 'submit':
+        await submit_draft(event, draft)
+        return
+    saved = await selected_day_counts(username, year, month)
+    if action == 'discard':
+        drafts.pop(user_id, event.message_id)
+        await event.answer("Changes discarded.")
+    elif action == 'undo':
+        await event.answer("Undone." if draft.undo() else "Nothing to undo.")
+    elif action.startswith('mode_') and action[len('mode_'):] in MODES:
+        draft.mode, draft.range_start = action[len('mode_'):], None
+        await event.answer({
+            'add': "Tap a day to add a class.",
+            'remove': "Tap a day to remove a class.",
+            'range': "Tap the first and the last day to add a class to each day between them.",
+        }[draft.mode])
+    elif not action.isdigit():
+        return
+    elif draft.mode == 'range' and draft.range_start is None:
+        draft.range_start = int(action)
+        await event.answer("Now tap the last day of the range.")
+    elif draft.mode == 'range':
+        first, last = sorted((draft.range_start, int(action)))
+        draft.range_start = None
+        changed = draft.apply(range(first, last + 1), 1, saved)
+        await event.answer(f"Added a class to {len(changed)} days, press Submit to save them.")
     else:
-        data = []
-
-    row_exists = False
-    for row in data:
-        if (row['Year'] == year and row['Month'] == month and row['Day'] == str(day_selected) and
-                row['USERNAME'] == username):
-            row['Count'] = str(int(row['Count']) + 1)
-            row_exists = True
-            break
-
-    # If the row does not exist, add a new one
-    if not row_exists:
-        new_row = {
-            'Year': year, 'Month': month, 'Day': str(day_selected), 'Count': '1',
-            'USERNAME': username, 'FIRST_NAME': first_name, 'LAST_NAME': last_name
-        }
-        data.append(new_row)
-    data.sort(key=lambda x: int(x['Day']))
-    # Write the updated data back to the CSV
-    with open(FILENAME, mode='w', encoding='utf-8', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=columns)
-        writer.writeheader()
-        writer.writerows(data)
-
-    with open(FILENAME, mode='r', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
-        filtered_rows = [row for row in reader if
-                         row['USERNAME'] == username and row['Year'] == str(year) and row['Month'] == str(month)]
-
-    output_filename = f"../data/{username}_{year}_{month}_classes.csv"
-    with open(output_filename, mode='w', encoding='utf-8', newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=reader.fieldnames)
-        writer.writeheader()
-        writer.writerows(filtered_rows)
-
-
-    await event.respond(f"Your classes for {calendar.month_name[int(month)]} {year} have been updated.",
-                        file=[output_filename])
+        day = int(action)
+        if draft.apply([day], 1 if draft.mode == 'add' else -1, saved):
+            await event.answer(f"{draft.counts(saved).get(day, 0)} class(es) on day {day}, press Submit to save.")
+        else:
+            await event.answer(f"There are no classes to remove on day {day}.")
+    await refresh_calendar(event, username, year, month)
+
+
+async def submit_draft(event, draft: Draft):
+    """
+    Saves the changes of a draft in a single storage transaction.
+    """
+    changes = draft.diff()
+    if not changes:
+        drafts.pop(event.sender_id, event.message_id)
+        await event.answer("There are no changes to save.")
+        return
+    username, first_name, last_name = await tutor_of(event)
+    await run_io(attendance.increment_many, [
+        (username, first_name, last_name, draft.year, draft.month, day, change) for day, change in changes
+    ])
+    drafts.pop(event.sender_id, event.message_id)
+    calendar_cache.invalidate((username or '', draft.year, draft.month))
+    await event.answer(f"Saved the changes of {len(changes)} day(s).")
+    await refresh_calendar(event, username, draft.year, draft.month)
+
+    if CALENDAR_REPLY_MODE == 'upload':
+        files = await run_io(export_attendance, STORAGE, username, (draft.year, draft.month), (draft.year, draft.month))
+        await event.respond(f"Your classes for {calendar.month_name[draft.month]} {draft.year} have been updated.",
+                            file=record_upload(files))
+
+
+def calendar_markup(user_id: int, message_id: Optional[int], year: int, month: int, selected_days: dict) -> list:
+    """
+    Builds the calendar keyboard of a month, with the changes of the draft
+    of the message, if any, in draft mode.
+    """
+    if CALENDAR_MODE != 'draft':
+        return create_calendar(year, month, selected_days)
+    draft = drafts.get(user_id, message_id) if message_id is not None else None
+    if draft is None:
+        return create_calendar(year, month, selected_days, mode='add')
+    return create_calendar(year, month, draft.counts(selected_days), changed=draft.changes.keys(),
+                           mode=draft.mode, range_start=draft.range_start)
+
+
+async def refresh_calendar(event, username, year: int, month: int):
+    """
+    Shows the updated classes of a tutor after a tap, editing the calendar or,
+    in instant mode, uploading the CSV summary depending on
+    `CALENDAR_REPLY_MODE`.
+
+    Taps on a calendar while its previous update is still being sent are
+    coalesced: they only trigger one more update, with the latest counts,
+    once the current one is done.
+    """
+    key = (event.sender_id, event.message_id)
+    if key in refreshing:
+        refreshing[key] = (username, year, month)
+        return
+    refreshing[key] = None
+    try:
+        while True:
+            if CALENDAR_REPLY_MODE == 'upload' and CALENDAR_MODE == 'instant':
+                files = await run_io(export_attendance, STORAGE, username, (year, month), (year, month))
+                await event.respond(f"Your classes for {calendar.month_name[month]} {year} have been updated.",
+                                    file=record_upload(files))
+            else:
+                selected_days = await selected_day_counts(username, year, month)
+                buttons = calendar_markup(event.sender_id, event.message_id, year, month, selected_days)
+                try:
+                    await event.edit(calendar_text(year, month, CALENDAR_MODE == 'draft'), buttons=buttons)
+                except MessageNotModifiedError:
+                    pass
+            if refreshing[key] is None:
+                break
+            (username, year, month), refreshing[key] = refreshing[key], None
+    finally:
+        del refreshing[key]
 
 async def handle_selection_help(event):
     # Extracting callback data
@@ -452,23 +892,20 @@ async def handle_selection_help(event):
     value = int(selected_data[1])
 
     user_id = event.sender_id
-    if user_id not in global_user_data:
-        global_user_data[user_id] = {}
-    user_data = global_user_data[user_id]
 
     if selection_type == "month":
-        user_data['selected_month'] = value
+        await run_io(sessions.update, user_id, selected_month=value)
         # Prompt for year selection
         await select_year(event)
     elif selection_type == "year":
-        user_data['selected_year'] = value
-        selected_month_name = calendar.month_name[user_data['selected_month']]
+        user_data = await run_io(sessions.update, user_id, selected_year=value)
+        selected_month_name = calendar.month_name[user_data.get('selected_month', datetime.datetime.now().month)]
         # Confirming the selection and providing further instructions
         await event.edit(f"You have selected {selected_month_name} {value}. "
                          f"Now run /selected_month_calendar to see the calendar.")
 
 
-@bot.on(events.CallbackQuery)
+@events.register(events.CallbackQuery)
 async def callback_query_handler(event):
     data = event.data.decode('utf-8')
     if data.startswith("select_month:"):
@@ -477,5 +914,135 @@ async def callback_query_handler(event):
         await handle_selection_classes(event)
 
 
+@events.register(NewMessage(func=lambda e: e.sender_id in conversations))
+async def conversation_handler(event: MessageEvent):
+    """
+    Routes the replies to the prompts of the bot.
+    """
+    handler = conversations.pop(event)
+    if handler is not None:
+        await handler(event)
+
+
+# in the order they are tried for every update
+HANDLERS = [
+    start_task_handler,
+    add_file_handler,
+    zip_handler,
+    cancel_handler,
+    start_handler,
+    help_handler,
+    handle_crypto_address,
+    handle_user_info_request,
+    handle_payroll_request,
+    ShowCalendar,
+    ShowCalendarCurrentMonth,
+    export_classes,
+    select_month,
+    callback_query_handler,
+    conversation_handler,
+]
+
+
+def create_app(session: str = USERNAME, receive_updates: bool = True, workers: int = 1) -> TelegramClient:
+    """
+    Opens the storage and builds the client with all the handlers, without
+    connecting it.
+
+    Args:
+        session: name of the Telethon session file.
+        receive_updates: False for sharded workers, which get the updates
+            from the receiver process instead of from Telegram.
+        workers: amount of processes sending messages, which share the
+            global rate limit of the bot.
+    """
+    global attendance, addresses, sessions
+
+    started = time.perf_counter()
+    store, addresses = open_storage(
+        STORAGE_BACKEND, FILENAME, ADDRESSES_FILENAME, DATABASE, compact_every=COMPACT_EVERY)
+    attendance = WriteBehindAttendance(store, max_pending=FLUSH_EVERY)
+    if STORAGE_BACKEND == 'sqlite':
+        sessions = SQLiteSessions(connect(DATABASE), ttl=SESSION_TTL)
+    else:
+        sessions = MemorySessions(ttl=SESSION_TTL, capacity=SESSION_CAPACITY, path=STORAGE / 'sessions.json')
+    tasks.update((user_id, manifest['messages']) for user_id, manifest in batches.load_all().items())
+    logging.info('Storage (%s) opened in %.2f s', STORAGE_BACKEND, time.perf_counter() - started)
+
+    # Telegram limits the bot, not each process; every user is handled by a single worker
+    limiter = RateLimiter(USER_RATE, USER_BURST, GLOBAL_RATE / workers, max(GLOBAL_BURST / workers, 1))
+    client = RateLimitedClient(session, api_id=API_ID, api_hash=API_HASH, receive_updates=receive_updates,
+                               limiter=limiter, max_flood_wait=MAX_FLOOD_WAIT)
+    for handler in HANDLERS:
+        # the wrapper keeps the events the handler was registered for
+        client.add_event_handler(metrics.instrument(handler))
+    return client
+
+
+async def flush_periodically(interval: float):
+    """
+    Writes the buffered calendar taps every `interval` seconds.
+    """
+    while True:
+        await sleep(interval)
+        try:
+            await run_io(attendance.flush)
+        except Exception:
+            logging.exception('Failed to flush the calendar taps')
+
+
+async def save_sessions_periodically(interval: float):
+    """
+    Drops the expired sessions and saves the rest every `interval` seconds.
+    """
+    while True:
+        await sleep(interval)
+        try:
+            await run_io(sessions.sweep)
+            await run_io(sessions.snapshot)
+        except Exception:
+            logging.exception('Failed to save the sessions')
+
+
+def run(client: TelegramClient, background: list = (), metrics_port: int = METRICS_PORT) -> None:
+    """
+    Connects the client and handles updates until it is disconnected,
+    flushing the buffered calendar taps and saving the sessions on the way
+    out.
+
+    Args:
+        client: the client returned by `create_app`.
+        background: coroutine functions started once connected.
+        metrics_port: port of the metrics endpoint, 0 to disable it.
+    """
+    started = time.perf_counter()
+    client.start(bot_token=BOT_TOKEN)
+    logging.info('Connected in %.2f s', time.perf_counter() - started)
+
+    if metrics_port:
+        client.loop.run_until_complete(metrics.serve(METRICS_HOST, metrics_port))
+        logging.info('Serving metrics on http://%s:%d/metrics', METRICS_HOST, metrics_port)
+
+    flusher = client.loop.create_task(flush_periodically(FLUSH_INTERVAL_MS / 1000))
+    saver = client.loop.create_task(save_sessions_periodically(SESSION_SNAPSHOT_INTERVAL))
+    for task in background:
+        client.loop.create_task(task())
+    # SIGTERM (container stop) disconnects, so the teardown below runs
+    client.loop.add_signal_handler(signal.SIGTERM, lambda: client.loop.create_task(client.disconnect()))
+    try:
+        client.run_until_disconnected()
+    finally:
+        flusher.cancel()
+        saver.cancel()
+        attendance.close()
+        sessions.snapshot()
+        io_executor.shutdown()
+
+
 if __name__ == '__main__':
-    bot.run_until_disconnected()
+    if WORKERS > 1:
+        from sharding import run_sharded
+        run_sharded(WORKERS)
+    else:
+        client = create_app()
+        run(client, background=[partial(resume_batches, client)])
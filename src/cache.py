@@ -0,0 +1,107 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, NamedTuple, Optional
+
+
+class LRUCache:
+    """
+    Mapping with a maximum amount of entries that evicts the least recently
+    used one when full.
+
+    Every invalidation bumps `generation`, so a value loaded concurrently with
+    a write can be discarded instead of caching stale data: read `generation`
+    before loading and pass it to `put`.
+
+    Args:
+        capacity: max amount of entries kept.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.capacity = capacity
+        self.generation = 0
+        self._data: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the value of `key` marking it as the most recently used.
+        """
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def put(self, key: Hashable, value: Any, generation: Optional[int] = None) -> None:
+        """
+        Stores a value, unless `generation` is given and some entry was
+        invalidated since it was read.
+        """
+        if self.capacity <= 0 or (generation is not None and generation != self.generation):
+            return
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.capacity:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Drops the entry of `key`, if any.
+        """
+        self.generation += 1
+        self._data.pop(key, None)
+
+
+class Profile(NamedTuple):
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+
+
+class ProfileCache:
+    """
+    Username and names of users, taken from the sender data that comes with
+    the updates and kept for `ttl` seconds, so handlers don't need to request
+    the entity to Telegram on every command or callback.
+
+    Args:
+        ttl: seconds a profile is considered fresh.
+        capacity: max amount of profiles kept.
+    """
+
+    def __init__(self, ttl: float = 3600, capacity: int = 10000):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # user_id -> (expiration time, profile)
+        self._profiles = LRUCache(capacity)
+
+    async def get(self, event) -> Profile:
+        """
+        Returns the profile of the sender of an event, refreshing it from
+        the event when stale.
+        """
+        entry = self._profiles.get(event.sender_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        sender = event.sender or await event.get_sender()
+        if sender is None:
+            sender = await event.client.get_entity(event.sender_id)
+        profile = Profile(
+            getattr(sender, 'username', None),
+            getattr(sender, 'first_name', None),
+            getattr(sender, 'last_name', None),
+        )
+        self._profiles.put(event.sender_id, (time.monotonic() + self.ttl, profile))
+        return profile
+
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._profiles)}
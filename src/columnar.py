@@ -0,0 +1,162 @@
+"""
+Columnar snapshot of one month of attendance, see `write_partition` for the
+layout of the files.
+"""
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+
+MAGIC = b'CTCS'
+VERSION = 1
+# magic, version, year, month, bytes per user index, rows, users, bytes of the users block
+HEADER = struct.Struct('<4sHHBBIII')
+# a count is stored in 16 bits
+MAX_COUNT = 0xFFFF
+
+
+def _pad(size: int) -> int:
+    return -size % 4
+
+
+def write_partition(path: Path, year: int, month: int, rows: Iterable[tuple]) -> int:
+    """
+    Atomically writes the rows of a month to a partition file.
+
+    The file has a fixed header followed by the dictionary of users, every
+    distinct (USERNAME, FIRST_NAME, LAST_NAME) sorted, as length-prefixed
+    UTF-8 strings, and then three columns of little-endian integers: the
+    index of the user of every row (16 bits, 32 with over 65535 users), the
+    count (16 bits) and the day (8 bits). Rows are sorted by user and day,
+    so the rows of a tutor are contiguous.
+
+    Args:
+        path: path of the partition, e.g. `selected_days/2024-05.col`.
+        year: year of the rows.
+        month: month of the rows.
+        rows: (USERNAME, FIRST_NAME, LAST_NAME, Day, Count) of every row.
+
+    Returns:
+        The amount of rows written.
+    """
+    rows = sorted((username or '', first_name or '', last_name or '', int(day), min(int(count), MAX_COUNT))
+                  for username, first_name, last_name, day, count in rows)
+    users = sorted({row[:3] for row in rows})
+    user_index = {user: index for index, user in enumerate(users)}
+    width = 2 if len(users) <= 0x10000 else 4
+
+    users_block = bytearray()
+    for user in users:
+        for value in user:
+            encoded = value.encode()[:0xFFFF]
+            users_block += struct.pack('<H', len(encoded)) + encoded
+    users_block += bytes(_pad(HEADER.size + len(users_block)))
+
+    user_column = array('H' if width == 2 else 'I', (user_index[row[:3]] for row in rows))
+    counts = array('H', (row[4] for row in rows))
+    days = array('B', (row[3] for row in rows))
+    if struct.pack('=H', 1) != struct.pack('<H', 1):
+        user_column.byteswap()
+        counts.byteswap()
+
+    tmp_path = path.with_suffix('.tmp')
+    with open(tmp_path, mode='wb') as file:
+        file.write(HEADER.pack(MAGIC, VERSION, year, month, width, len(rows), len(users), len(users_block)))
+        file.write(users_block)
+        file.write(user_column.tobytes())
+        file.write(bytes(_pad(len(rows) * width)))
+        file.write(counts.tobytes())
+        file.write(days.tobytes())
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    return len(rows)
+
+
+def read_header(path: Path) -> tuple[int, int, int]:
+    """
+    Returns the year, month and amount of rows of a partition.
+    """
+    with open(path, mode='rb') as file:
+        magic, version, year, month, _, rows, _, _ = HEADER.unpack(file.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f'{path} is not a partition')
+    return year, month, rows
+
+
+class Partition:
+    """
+    Memory mapped partition written by `write_partition`. Only the users
+    dictionary is decoded when opened, the columns are read in place.
+
+    Meant to be used as a context manager, the rows can't be read once it
+    is closed.
+    """
+
+    def __init__(self, path: Path):
+        with open(path, mode='rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, version, self.year, self.month, width, self.size, users, users_size = HEADER.unpack_from(view)
+        if magic != MAGIC or version != VERSION:
+            view.release()
+            self._mmap.close()
+            raise ValueError(f'{path} is not a partition')
+
+        self.users = []
+        offset = HEADER.size
+        for _ in range(users):
+            user = []
+            for _ in range(3):
+                length, = struct.unpack_from('<H', view, offset)
+                user.append(str(view[offset + 2:offset + 2 + length], 'utf-8'))
+                offset += 2 + length
+            self.users.append(tuple(user))
+
+        offset = HEADER.size + users_size
+        self._views = [view]
+        self.user_column = self._column(view, offset, self.size * width, 'H' if width == 2 else 'I')
+        offset += self.size * width + _pad(self.size * width)
+        self.counts = self._column(view, offset, self.size * 2, 'H')
+        offset += self.size * 2
+        self.days = self._column(view, offset, self.size, 'B')
+
+    def _column(self, view: memoryview, offset: int, size: int, typecode: str):
+        column = view[offset:offset + size].cast(typecode)
+        self._views.append(column)
+        if typecode != 'B' and struct.pack('=H', 1) != struct.pack('<H', 1):
+            column = array(typecode, column)
+            column.byteswap()
+        return column
+
+    def _range(self, username: Optional[str]) -> range:
+        if username is None:
+            return range(self.size)
+        # users are sorted, so the names of a tutor are contiguous
+        first_user = bisect_left(self.users, (username,))
+        last_user = bisect_left(self.users, (username + '\0',))
+        return range(bisect_left(self.user_column, first_user), bisect_left(self.user_column, last_user))
+
+    def rows(self, username: Optional[str] = None) -> Iterator[tuple]:
+        """
+        Yields the (USERNAME, FIRST_NAME, LAST_NAME, Day, Count) of every row,
+        or only of those of a tutor.
+        """
+        users, user_column, days, counts = self.users, self.user_column, self.days, self.counts
+        for i in self._range(username):
+            yield (*users[user_column[i]], days[i], counts[i])
+
+    def close(self) -> None:
+        for view in reversed(self._views):
+            view.release()
+        self._mmap.close()
+
+    def __enter__(self) -> 'Partition':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
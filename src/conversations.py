@@ -0,0 +1,97 @@
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+
+ReplyHandler = Callable[..., Awaitable[None]]
+
+
+class PendingReply(NamedTuple):
+    expires_at: float
+    origin_id: int
+    handler: ReplyHandler
+    func: Optional[Callable[..., bool]]
+
+
+class Conversations:
+    """
+    Replies that the bot is waiting for, at most one per user.
+
+    A command that asks the user for something registers the coroutine that
+    handles the answer with `expect`, and a single message handler routes the
+    next matching message of that user to it with `pop`. Prompts that are not
+    answered in `timeout` seconds are dropped, and when there are more than
+    `capacity` pending prompts the oldest ones are dropped too.
+
+    Args:
+        timeout: seconds to wait for a reply.
+        capacity: max amount of pending replies.
+    """
+
+    def __init__(self, timeout: float = 600, capacity: int = 10000):
+        self.timeout = timeout
+        self.capacity = capacity
+        # user_id -> pending reply, ordered by expiration time
+        self._pending: OrderedDict[int, PendingReply] = OrderedDict()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._pending
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def expect(
+        self,
+        event,
+        handler: ReplyHandler,
+        func: Optional[Callable[..., bool]] = None
+    ) -> None:
+        """
+        Waits for the next message of the sender of `event`, replacing any
+        previous prompt of that user.
+
+        Args:
+            event: the event of the command that asks for a reply.
+            handler: coroutine function called with the reply event.
+            func: only messages for which it returns True are replies.
+        """
+        self._pending.pop(event.sender_id, None)
+        self._pending[event.sender_id] = PendingReply(
+            time.monotonic() + self.timeout, event.id, handler, func)
+        self.sweep()
+        while len(self._pending) > self.capacity:
+            self._pending.popitem(last=False)
+
+    def pop(self, event) -> Optional[ReplyHandler]:
+        """
+        Returns the handler waiting for `event`, if it is a reply, and stops
+        waiting.
+        """
+        pending = self._pending.get(event.sender_id)
+        if pending is None or event.id <= pending.origin_id:
+            return None
+        if pending.expires_at <= time.monotonic():
+            del self._pending[event.sender_id]
+            return None
+        if pending.func is not None and not pending.func(event):
+            return None
+
+        del self._pending[event.sender_id]
+        return pending.handler
+
+    def sweep(self) -> int:
+        """
+        Drops the expired prompts.
+
+        Returns:
+            The amount of prompts dropped.
+        """
+        now = time.monotonic()
+        dropped = 0
+        while self._pending:
+            user_id, pending = next(iter(self._pending.items()))
+            if pending.expires_at > now:
+                break
+            del self._pending[user_id]
+            dropped += 1
+        return dropped
@@ -0,0 +1,147 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+MODES = ('add', 'remove', 'range')
+
+
+class Draft:
+    """
+    Changes made on a calendar message that are not saved yet.
+
+    Args:
+        year: year of the calendar.
+        month: month of the calendar.
+    """
+
+    __slots__ = ('year', 'month', 'changes', 'history', 'mode', 'range_start', 'expires_at')
+
+    def __init__(self, year: int, month: int):
+        self.year = year
+        self.month = month
+        # day -> classes added (or removed, if negative)
+        self.changes: dict[int, int] = {}
+        # every tap as [(day, classes added)], for undo
+        self.history: list[list[tuple[int, int]]] = []
+        self.mode = 'add'
+        # first day of a range being selected
+        self.range_start: Optional[int] = None
+        self.expires_at = 0.0
+
+    def counts(self, saved: dict[int, int]) -> dict[int, int]:
+        """
+        Returns the classes per day once the draft is saved.
+        """
+        counts = dict(saved)
+        for day, change in self.changes.items():
+            counts[day] = counts.get(day, 0) + change
+            if counts[day] <= 0:
+                del counts[day]
+        return counts
+
+    def apply(self, days, change: int, saved: dict[int, int]) -> list[int]:
+        """
+        Adds `change` classes to each of `days`, never leaving a day below
+        zero, and records it as one step for `undo`.
+
+        Returns:
+            The days that changed.
+        """
+        counts = self.counts(saved)
+        step = []
+        for day in days:
+            day_change = max(change, -counts.get(day, 0))
+            if day_change:
+                self.changes[day] = self.changes.get(day, 0) + day_change
+                if not self.changes[day]:
+                    del self.changes[day]
+                step.append((day, day_change))
+        if step:
+            self.history.append(step)
+        return [day for day, _ in step]
+
+    def undo(self) -> bool:
+        """
+        Reverts the last step.
+
+        Returns:
+            Whether there was a step to revert.
+        """
+        self.range_start = None
+        if not self.history:
+            return False
+        for day, change in self.history.pop():
+            self.changes[day] = self.changes.get(day, 0) - change
+            if not self.changes[day]:
+                del self.changes[day]
+        return True
+
+    def diff(self) -> list[tuple[int, int]]:
+        """
+        Returns the (day, classes added) to save, sorted by day.
+        """
+        return sorted((day, change) for day, change in self.changes.items() if change)
+
+
+class Drafts:
+    """
+    Drafts of the calendar messages being edited, keyed by (user, message).
+    A draft is dropped `timeout` seconds after its last change, and the
+    oldest ones beyond `capacity`.
+
+    Args:
+        timeout: seconds a draft is kept since it was last changed.
+        capacity: max amount of drafts.
+    """
+
+    def __init__(self, timeout: float = 3600, capacity: int = 10000):
+        self.timeout = timeout
+        self.capacity = capacity
+        # (user_id, message_id) -> draft, least recently changed first
+        self._drafts: OrderedDict[tuple[int, int], Draft] = OrderedDict()
+
+    def get(self, user_id: int, message_id: int) -> Optional[Draft]:
+        """
+        Returns the draft of a calendar message, if it has one.
+        """
+        self.sweep()
+        return self._drafts.get((user_id, message_id))
+
+    def open(self, user_id: int, message_id: int, year: int, month: int) -> Draft:
+        """
+        Returns the draft of a calendar message, creating it if needed, and
+        extends its life.
+        """
+        key = (user_id, message_id)
+        draft = self.get(user_id, message_id)
+        if draft is None:
+            draft = self._drafts[key] = Draft(year, month)
+            while len(self._drafts) > self.capacity:
+                self._drafts.popitem(last=False)
+        draft.expires_at = time.monotonic() + self.timeout
+        self._drafts.move_to_end(key)
+        return draft
+
+    def pop(self, user_id: int, message_id: int) -> Optional[Draft]:
+        return self._drafts.pop((user_id, message_id), None)
+
+    def sweep(self) -> int:
+        """
+        Drops the expired drafts.
+
+        Returns:
+            The amount of drafts dropped.
+        """
+        now = time.monotonic()
+        dropped = 0
+        while self._drafts:
+            key, draft = next(iter(self._drafts.items()))
+            if draft.expires_at > now:
+                break
+            del self._drafts[key]
+            dropped += 1
+        return dropped
+
+    def __len__(self) -> int:
+        return len(self._drafts)
@@ -0,0 +1,100 @@
+import csv
+import gzip
+import io
+import os
+from pathlib import Path
+from typing import Iterable, Iterator
+from zipfile import ZIP_DEFLATED
+
+from utils import add_to_zip
+
+
+# Telegram refuses files over 2 GB, leave room for the zip and gzip framing
+DEFAULT_PART_SIZE = 1950 * 1024 * 1024
+COMPRESSIONS = ('none', 'gzip', 'zip')
+
+
+def csv_chunks(rows: Iterable, chunk_size: int = 64 * 1024) -> Iterator[bytes]:
+    """
+    Encodes rows as CSV lines, joined in chunks of about `chunk_size` bytes.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _open_part(path: Path, compression: str):
+    if compression == 'gzip':
+        return gzip.open(path, 'wb')
+    return open(path, 'wb')
+
+
+def write_parts(
+    name: str,
+    columns: list[str],
+    rows: Iterable,
+    directory: Path,
+    compression: str = 'zip',
+    part_size: int = DEFAULT_PART_SIZE
+) -> list[Path]:
+    """
+    Streams rows into CSV files of at most `part_size` bytes of CSV each, so
+    every part can be uploaded to Telegram. Only one chunk of rows is held in
+    memory at a time.
+
+    Args:
+        name: name of the CSV file without extension, e.g. 'selected_days'.
+        columns: header, repeated at the top of every part.
+        rows: iterable of rows with the layout of `columns`.
+        directory: existing directory where the parts are written.
+        compression: 'none' for plain CSV files, 'gzip' for `.csv.gz` files or
+            'zip' for `.zip` files holding one CSV file each.
+        part_size: max bytes of CSV per part, before compression.
+
+    Returns:
+        The paths of the parts, a single one named `name` if it all fits.
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f'Unknown compression {compression!r}, use one of {COMPRESSIONS}')
+    header = next(csv_chunks([columns]))
+
+    csv_paths = []
+    file, written = None, 0
+    for chunk in csv_chunks(rows):
+        if file is None or written + len(chunk) > part_size:
+            if file is not None:
+                file.close()
+            csv_paths.append(directory / f'{name}.part{len(csv_paths) + 1}.csv')
+            file = _open_part(csv_paths[-1], compression)
+            file.write(header)
+            written = len(header)
+        file.write(chunk)
+        written += len(chunk)
+    if file is None:
+        csv_paths.append(directory / f'{name}.part1.csv')
+        file = _open_part(csv_paths[-1], compression)
+        file.write(header)
+    file.close()
+
+    if len(csv_paths) == 1:
+        os.replace(csv_paths[0], directory / f'{name}.csv')
+        csv_paths = [directory / f'{name}.csv']
+
+    parts = []
+    for path in csv_paths:
+        if compression == 'gzip':
+            parts.append(path.rename(path.with_name(path.name + '.gz')))
+        elif compression == 'zip':
+            parts.append(path.with_suffix('.zip'))
+            add_to_zip(parts[-1], path, ZIP_DEFLATED)
+            path.unlink()
+        else:
+            parts.append(path)
+    return parts
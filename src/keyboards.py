@@ -0,0 +1,137 @@
+import calendar
+from functools import lru_cache
+
+from telethon import Button
+
+
+WEEK_DAYS = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+
+def calendar_text(year: int, month: int, draft: bool = False) -> str:
+    text = f"Please select the days in {calendar.month_name[month]} {year} when you had classes:"
+    if draft:
+        text += "\n\nChanges (✏️) are saved when you press Submit."
+    return text
+
+
+@lru_cache(maxsize=64)
+def _calendar_skeleton(year: int, month: int) -> tuple[tuple, dict[int, tuple[int, int]]]:
+    """
+    Builds the keyboard of a month without selected days.
+
+    Returns:
+        The rows of buttons and the (row, column) of every day in them.
+    """
+    markup = []
+    # Select a Different Month button
+    markup.append((Button.inline("Select a Different Month", data="classes:selecting_month"),))
+    # Weekdays header
+    markup.append(tuple(Button.inline(day, data="ignore") for day in WEEK_DAYS))
+    # Calendar days
+    positions = {}
+    for week in calendar.monthcalendar(year, month):
+        row = []
+        for day in week:
+            if day == 0:
+                row.append(Button.inline(" ", data="ignore"))
+                continue
+            positions[day] = (len(markup), len(row))
+            row.append(_day_button(day, 0))
+        markup.append(tuple(row))
+    return tuple(markup), positions
+
+
+@lru_cache(maxsize=1024)
+def _day_button(day: int, count: int, changed: bool = False, range_start: bool = False, pending: bool = False):
+    if not count:
+        text = str(day)
+    elif count > 1:
+        text = f"{day}🧑‍🏫{count}"
+    else:
+        text = f"{day}🧑‍🏫"
+    if changed:
+        text += "✏️"
+    if range_start:
+        text = "▶️" + text
+    return Button.inline(text, data=_data(str(day), pending))
+
+
+def _data(action: str, pending: bool) -> str:
+    # taps on a calendar showing unsaved changes say so, to tell when its draft is lost
+    return f"classes:{action}:pending" if pending else f"classes:{action}"
+
+
+DRAFT_MODES = (("add", "➕ Add"), ("remove", "➖ Remove"), ("range", "↔️ Range"))
+
+
+@lru_cache(maxsize=2 * len(DRAFT_MODES))
+def _draft_footer(mode: str, pending: bool = False) -> tuple:
+    modes = tuple(
+        Button.inline(f"✔️ {label}" if name == mode else label, data=_data(f"mode_{name}", pending))
+        for name, label in DRAFT_MODES
+    )
+    actions = (
+        Button.inline("↩️ Undo", data=_data("undo", pending)),
+        Button.inline("❌ Discard", data=_data("discard", pending)),
+        Button.inline("💾 Submit", data=_data("submit", pending)),
+    )
+    return modes, actions
+
+
+def create_calendar(year, month, selected_days, changed=(), mode=None, range_start=None):
+    """
+    Builds the calendar keyboard of a month. `selected_days` can be a
+    collection of days or a dict day -> amount of classes, in which case
+    days with more than one class show the count.
+
+    With a draft `mode` ('add', 'remove' or 'range') the keyboard also has
+    the buttons to pick the mode, undo, discard and submit, the `changed`
+    days are marked as not saved and `range_start` as the start of a range.
+    When there are `changed` days, the data of every button ends with
+    `:pending`.
+
+    The empty month is built once and memoized, only the buttons of the
+    selected days are replaced on every call.
+    """
+    skeleton, positions = _calendar_skeleton(year, month)
+    markup = [list(row) for row in skeleton]
+    pending = bool(changed)
+    days = positions if pending else set(selected_days) | set(changed) | ({range_start} if range_start else set())
+    for day in days:
+        position = positions.get(day)
+        if position is None:
+            continue
+        if isinstance(selected_days, dict):
+            count = selected_days.get(day, 0)
+        else:
+            count = int(day in selected_days)
+        markup[position[0]][position[1]] = _day_button(day, count, day in changed, day == range_start, pending)
+    if mode is not None:
+        markup.extend(list(row) for row in _draft_footer(mode, pending))
+    return markup
+
+
+def _group(buttons: list, size: int = 3) -> tuple:
+    # Grouping buttons in rows of three
+    return tuple(tuple(buttons[i:i + size]) for i in range(0, len(buttons), size))
+
+
+MONTH_MARKUP = _group([
+    Button.inline(calendar.month_abbr[i], f"select_month:month_{i}") for i in range(1, 13)
+])
+
+
+def month_markup() -> list:
+    return [list(row) for row in MONTH_MARKUP]
+
+
+@lru_cache(maxsize=2)
+def _year_markup(current_year: int) -> tuple:
+    return _group([
+        Button.inline(str(year), f"select_month:year_{year}")
+        for year in range(current_year - 5, current_year + 6)
+    ])
+
+
+def year_markup(current_year: int) -> list:
+    return [list(row) for row in _year_markup(current_year)]
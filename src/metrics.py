@@ -0,0 +1,175 @@
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable
+
+from telethon.events import StopPropagation
+
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# metrics in the order they are exposed
+REGISTRY: list = []
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """
+    Monotonic count, optionally split by labels.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name: str, description: str, labels: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values: dict[tuple, float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, value: float = 1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name + _labels(self.labels, key), value
+
+
+class Gauge:
+    """
+    Value read from `callback` when the metrics are exposed.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, description: str, callback: Callable[[], float]):
+        self.name = name
+        self.description = description
+        self.callback = callback
+        REGISTRY.append(self)
+
+    def samples(self):
+        yield self.name, self.callback()
+
+
+class Histogram:
+    """
+    Distribution of observed values in cumulative buckets, optionally split
+    by labels.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # labels -> [count per bucket (+Inf last), sum]
+        self._values: dict[tuple, list] = {}
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        counts, _ = self._values.setdefault(key, [[0] * (len(self.buckets) + 1), 0])
+        counts[bisect_left(self.buckets, value)] += 1
+        self._values[key][1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket' + _labels(self.labels, key, f'le="{bound}"'), cumulative
+            yield f'{self.name}_sum' + _labels(self.labels, key), total
+            yield f'{self.name}_count' + _labels(self.labels, key), cumulative
+
+
+HANDLER_CALLS = Counter('bot_handler_calls_total', 'Updates handled per handler.', ('handler',))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Handlers that raised an error.', ('handler',))
+HANDLER_LATENCY = Histogram('bot_handler_latency_seconds', 'Time spent in each handler.', ('handler',))
+STORAGE_IO = Histogram('bot_storage_io_seconds', 'Time spent in blocking storage calls.', ('operation',))
+UPLOAD_BYTES = Counter('bot_upload_bytes_total', 'Bytes of the files sent to Telegram.')
+FLOOD_WAITS = Counter('bot_flood_waits_total', 'FloodWait errors returned by Telegram.')
+FLOOD_WAIT_SECONDS = Counter('bot_flood_wait_seconds_total', 'Seconds Telegram asked to wait.')
+
+
+def render() -> str:
+    """
+    Returns all the metrics in the Prometheus text format.
+    """
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, value in metric.samples():
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def instrument(handler):
+    """
+    Wraps an event handler to count its calls and errors and to time it. The
+    events registered for `handler` are kept. FloodWaits are counted by
+    `ratelimit.RateLimitedClient`, where they are raised.
+    """
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(event):
+        HANDLER_CALLS.inc(handler=name)
+        started = time.perf_counter()
+        try:
+            return await handler(event)
+        except StopPropagation:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await reader.readline()
+        # skip the headers
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        if request.split(b' ')[1:2] == [b'/metrics']:
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> asyncio.AbstractServer:
+    """
+    Exposes the metrics on http://host:port/metrics.
+    """
+    return await asyncio.start_server(_handle_request, host, port)
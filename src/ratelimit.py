@@ -0,0 +1,180 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from telethon import TelegramClient, utils
+from telethon.errors import FloodWaitError
+from telethon.tl import functions, types
+
+import metrics
+
+
+# requests that send something to a chat, the ones Telegram throttles
+LIMITED_REQUESTS = (
+    functions.messages.SendMessageRequest,
+    functions.messages.SendMediaRequest,
+    functions.messages.SendMultiMediaRequest,
+    functions.messages.EditMessageRequest,
+    functions.messages.ForwardMessagesRequest,
+    functions.messages.SetBotCallbackAnswerRequest,
+)
+
+
+class TokenBucket:
+    """
+    Allows `rate` calls per second on average and bursts of up to `burst`
+    calls.
+
+    Tokens are reserved in arrival order and can go negative, so waiting
+    callers are served first come, first served without a lock.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def reserve(self) -> float:
+        """
+        Takes a token.
+
+        Returns:
+            Seconds to wait before using it.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(-self.tokens / self.rate, self.paused_until - now, 0)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Holds every call for `seconds`, e.g. after a FloodWait.
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        """
+        Tells whether the bucket is full again, so dropping it changes nothing.
+        """
+        now = time.monotonic()
+        return now >= self.paused_until and self.tokens + (now - self.updated) * self.rate >= self.burst
+
+    async def acquire(self) -> None:
+        delay = self.reserve()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            # a pause may have started while waiting
+            delay = self.paused_until - time.monotonic()
+
+
+class RateLimiter:
+    """
+    Token buckets for the calls sent to every user and for all the calls of
+    the bot, so a user spamming buttons only slows down their own replies.
+
+    Args:
+        user_rate: calls per second to the same user.
+        user_burst: calls in a row to the same user before throttling.
+        global_rate: calls per second of the whole bot.
+        global_burst: calls in a row of the whole bot before throttling.
+        capacity: max amount of users with a bucket in memory, the least
+            recently used idle buckets are dropped.
+    """
+
+    def __init__(
+        self,
+        user_rate: float = 1,
+        user_burst: float = 3,
+        global_rate: float = 30,
+        global_burst: float = 30,
+        capacity: int = 10000
+    ):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.capacity = capacity
+        self.bucket = TokenBucket(global_rate, global_burst)
+        self._users: OrderedDict[int, TokenBucket] = OrderedDict()
+
+    def user_bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.user_rate, self.user_burst)
+            if len(self._users) > self.capacity:
+                oldest_id, oldest = next(iter(self._users.items()))
+                if oldest.idle():
+                    del self._users[oldest_id]
+        self._users.move_to_end(user_id)
+        return bucket
+
+    async def acquire(self, user_id: Optional[int] = None) -> None:
+        """
+        Waits until a call to `user_id`, if any, is allowed.
+        """
+        if user_id is not None:
+            await self.user_bucket(user_id).acquire()
+        await self.bucket.acquire()
+
+    def pause(self, user_id: Optional[int], seconds: float) -> None:
+        """
+        Holds the calls to `user_id`, or all of them without user.
+        """
+        (self.user_bucket(user_id) if user_id is not None else self.bucket).pause(seconds)
+
+
+def _user_of(request) -> Optional[int]:
+    peer = getattr(request, 'peer', None)
+    return peer.user_id if isinstance(peer, types.InputPeerUser) else None
+
+
+class RateLimitedClient(TelegramClient):
+    """
+    TelegramClient that sends the requests of `LIMITED_REQUESTS` through a
+    `RateLimiter` and handles the FloodWaits of every request in one place.
+
+    A FloodWait on a limited request pauses only the user the request was
+    for (or the whole bot for requests without user), instead of holding
+    every request of the same type for all users as Telethon does. Other
+    requests sleep. Either way the FloodWait is counted in the metrics and
+    the request is retried, unless the wait is longer than
+    `max_flood_wait` seconds, in which case it is raised.
+
+    Args:
+        limiter: limiter shared by all the calls of the client.
+        max_flood_wait: longest FloodWait that is waited and retried.
+    """
+
+    def __init__(self, *args, limiter: RateLimiter, max_flood_wait: float = 60, **kwargs):
+        # FloodWaits are handled by _call
+        kwargs['flood_sleep_threshold'] = 0
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+        self.max_flood_wait = max_flood_wait
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        limited = isinstance(request, LIMITED_REQUESTS)
+        user_id = None
+        if limited:
+            await request.resolve(self, utils)
+            user_id = _user_of(request)
+        while True:
+            if limited:
+                await self.limiter.acquire(user_id)
+            try:
+                return await super()._call(sender, request, ordered, flood_sleep_threshold)
+            except FloodWaitError as e:
+                metrics.FLOOD_WAITS.inc()
+                metrics.FLOOD_WAIT_SECONDS.inc(e.seconds)
+                if limited:
+                    # the wait applies to this user, not to every request of the type
+                    self._flood_waited_requests.pop(request.CONSTRUCTOR_ID, None)
+                    self.limiter.pause(user_id, e.seconds)
+                if e.seconds > self.max_flood_wait:
+                    raise
+                logging.info('FloodWait of %d s sending %s to %s', e.seconds, type(request).__name__, user_id)
+                if not limited:
+                    await asyncio.sleep(e.seconds)
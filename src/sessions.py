@@ -0,0 +1,244 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+
+FIELDS = ('selected_year', 'selected_month')
+
+
+class Session:
+    """
+    Month selected by a user and when the selection is forgotten.
+    """
+
+    __slots__ = FIELDS + ('expires_at',)
+
+    def __init__(self, selected_year: Optional[int] = None, selected_month: Optional[int] = None,
+                 expires_at: float = 0.0):
+        self.selected_year = selected_year
+        self.selected_month = selected_month
+        self.expires_at = expires_at
+
+    def as_dict(self) -> dict:
+        return {field: getattr(self, field) for field in FIELDS if getattr(self, field) is not None}
+
+
+class MemorySessions:
+    """
+    Month selected by every user, kept in the memory of the process.
+
+    A session is forgotten `ttl` seconds after it was last used, and the
+    least recently used ones are dropped beyond `capacity`, so memory stays
+    bounded however many users the bot has. With a `path`, sessions are
+    restored from it when created and written to it by `snapshot`.
+
+    All public methods are thread safe, so they can be run in an executor.
+
+    Args:
+        ttl: seconds a session is kept since it was last used.
+        capacity: max amount of sessions.
+        path: JSON file where the sessions are saved, e.g. `sessions.json`.
+    """
+
+    def __init__(self, ttl: float = 30 * 24 * 3600, capacity: int = 100000, path: Optional[Path] = None):
+        self.ttl = ttl
+        self.capacity = capacity
+        self.path = Path(path) if path else None
+        # user_id -> session, least recently used first
+        self._sessions: OrderedDict[int, Session] = OrderedDict()
+        self._lock = threading.Lock()
+        # changed since the last snapshot
+        self._dirty = False
+        if self.path is not None and self.path.is_file():
+            self._restore()
+
+    def _restore(self) -> None:
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                saved = json.load(file)
+        except (ValueError, OSError):
+            return
+        now = time.time()
+        for user_id, (selected_year, selected_month, expires_at) in sorted(saved.items(), key=lambda item: item[1][2]):
+            if expires_at > now:
+                self._sessions[int(user_id)] = Session(selected_year, selected_month, expires_at)
+
+    def _touch(self, user_id: int, session: Session) -> None:
+        session.expires_at = time.time() + self.ttl
+        self._sessions.move_to_end(user_id)
+        self._dirty = True
+
+    def get(self, user_id: int) -> dict:
+        """
+        Returns a copy of the session of the user, empty if it has none.
+        """
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                return {}
+            if session.expires_at <= time.time():
+                del self._sessions[user_id]
+                self._dirty = True
+                return {}
+            self._touch(user_id, session)
+            return session.as_dict()
+
+    def update(self, user_id: int, **fields) -> dict:
+        """
+        Sets some fields of the session of the user.
+
+        Returns:
+            A copy of the updated session.
+        """
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None or session.expires_at <= time.time():
+                session = self._sessions[user_id] = Session()
+            for field, value in fields.items():
+                setattr(session, field, value)
+            self._touch(user_id, session)
+            self._evict()
+            return session.as_dict()
+
+    def _evict(self) -> None:
+        now = time.time()
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if session.expires_at > now and len(self._sessions) <= self.capacity:
+                break
+            del self._sessions[user_id]
+
+    def sweep(self) -> int:
+        """
+        Drops the expired sessions.
+
+        Returns:
+            The amount of sessions left.
+        """
+        with self._lock:
+            before = len(self._sessions)
+            self._evict()
+            self._dirty |= len(self._sessions) != before
+            return len(self._sessions)
+
+    def snapshot(self) -> bool:
+        """
+        Atomically writes the sessions to `path`, if they changed since the
+        last snapshot.
+
+        Returns:
+            Whether the file was written.
+        """
+        if self.path is None:
+            return False
+        with self._lock:
+            if not self._dirty:
+                return False
+            saved = {
+                user_id: [session.selected_year, session.selected_month, session.expires_at]
+                for user_id, session in self._sessions.items()
+            }
+            self._dirty = False
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, mode='w', encoding='utf-8') as file:
+            json.dump(saved, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        return True
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+
+class SQLiteSessions:
+    """
+    Month selected by every user, kept in a SQLite table so it is shared by
+    all the worker processes and survives restarts. Sessions not used for
+    `ttl` seconds are ignored and deleted by `sweep`.
+
+    Args:
+        connection: connection returned by `storage.connect`.
+        ttl: seconds a session is kept since it was last used.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, ttl: float = 30 * 24 * 3600):
+        self.ttl = ttl
+        self._db = connection
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS user_sessions ('
+                'USER_ID INTEGER PRIMARY KEY, selected_year INTEGER, selected_month INTEGER, '
+                'expires_at REAL NOT NULL DEFAULT 0)'
+            )
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(user_sessions)')]
+            if 'expires_at' not in columns:
+                self._db.execute('ALTER TABLE user_sessions ADD COLUMN expires_at REAL NOT NULL DEFAULT 0')
+                self._db.execute('UPDATE user_sessions SET expires_at = ?', (time.time() + ttl,))
+
+    def get(self, user_id: int) -> dict:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT selected_year, selected_month, expires_at FROM user_sessions '
+                'WHERE USER_ID = ? AND expires_at > ?', (user_id, now)
+            ).fetchone()
+            # extend the session, writing only once half of it has passed
+            if row is not None and row[2] - now < self.ttl / 2:
+                self._db.execute('UPDATE user_sessions SET expires_at = ? WHERE USER_ID = ?', (now + self.ttl, user_id))
+        return _as_session(row)
+
+    def update(self, user_id: int, **fields) -> dict:
+        now = time.time()
+        values = [fields.get(field) for field in FIELDS]
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                # an expired session starts empty
+                self._db.execute('DELETE FROM user_sessions WHERE USER_ID = ? AND expires_at <= ?', (user_id, now))
+                self._db.execute(
+                    'INSERT INTO user_sessions (USER_ID, selected_year, selected_month, expires_at) '
+                    'VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (USER_ID) DO UPDATE SET '
+                    'selected_year = COALESCE(excluded.selected_year, selected_year), '
+                    'selected_month = COALESCE(excluded.selected_month, selected_month), '
+                    'expires_at = excluded.expires_at',
+                    (user_id, *values, now + self.ttl)
+                )
+                row = self._db.execute(
+                    'SELECT selected_year, selected_month FROM user_sessions WHERE USER_ID = ?', (user_id,)
+                ).fetchone()
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return _as_session(row)
+
+    def sweep(self) -> int:
+        """
+        Deletes the expired sessions.
+
+        Returns:
+            The amount of sessions left.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM user_sessions WHERE expires_at <= ?', (time.time(),))
+            return self._db.execute('SELECT COUNT(*) FROM user_sessions').fetchone()[0]
+
+    def snapshot(self) -> bool:
+        """
+        Sessions are written as they change.
+        """
+        return False
+
+
+def _as_session(row: Optional[tuple]) -> dict:
+    if row is None:
+        return {}
+    return {field: value for field, value in zip(FIELDS, row) if value is not None}
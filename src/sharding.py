@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import multiprocessing
+import signal
+import zlib
+from typing import Optional
+
+from telethon import TelegramClient, events, types
+
+from storage import open_storage
+
+
+def sender_of(update) -> Optional[int]:
+    """
+    Returns the ID of the user that caused an update, if it has one.
+    """
+    if isinstance(update, (types.UpdateShortMessage, types.UpdateBotCallbackQuery,
+                           types.UpdateInlineBotCallbackQuery)):
+        return update.user_id
+    message = getattr(update, 'message', None)
+    if isinstance(message, (types.Message, types.MessageService)):
+        peer = message.from_id or message.peer_id
+        if isinstance(peer, types.PeerUser):
+            return peer.user_id
+    return None
+
+
+def shard_of(user_id: Optional[int], workers: int) -> int:
+    """
+    Returns the worker that handles the updates of a user. Updates without
+    user go to the first worker.
+    """
+    if user_id is None:
+        return 0
+    return zlib.crc32(str(user_id).encode()) % workers
+
+
+async def _consume(client: TelegramClient, queue: multiprocessing.Queue):
+    """
+    Dispatches the updates forwarded by the receiver to the handlers of
+    `client`, until it gets None.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        update = await loop.run_in_executor(None, queue.get)
+        if update is None:
+            await client.disconnect()
+            return
+        entities = getattr(update, '_entities', None) or {}
+        # what _handle_update does for the updates received from Telegram, so
+        # the handlers don't fetch the difference to resolve these users
+        client._entity_cache.add(list(entities.values()))
+        client._process_update(update, None, entities=entities)
+
+
+def _worker_main(index: int, workers: int, queue: multiprocessing.Queue):
+    import bot
+
+    client = bot.create_app(session=f'{bot.USERNAME}-worker{index}', receive_updates=False, workers=workers)
+    metrics_port = bot.METRICS_PORT + 1 + index if bot.METRICS_PORT else 0
+    logging.info('Worker %d started', index)
+    bot.run(client, background=[
+        lambda: _consume(client, queue),
+        lambda: bot.resume_batches(client, lambda user_id: shard_of(user_id, workers) == index),
+    ], metrics_port=metrics_port)
+
+
+def run_sharded(workers: int) -> None:
+    """
+    Receives the updates in this process and hands every one to one of
+    `workers` processes, chosen by the hash of the sender, so all the updates
+    of a user are handled in order by the same worker.
+
+    Workers only send requests to Telegram, with their own session, and share
+    the attendance, addresses and selected months through the SQLite backend.
+    """
+    import bot
+
+    if bot.STORAGE_BACKEND != 'sqlite':
+        raise SystemExit('Running more than one worker requires STORAGE_BACKEND=sqlite')
+
+    # import the CSV files, if the database is new, before the workers open it
+    for store in open_storage(bot.STORAGE_BACKEND, bot.FILENAME, bot.ADDRESSES_FILENAME, bot.DATABASE,
+                              compact_every=bot.COMPACT_EVERY):
+        store.close()
+
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue() for _ in range(workers)]
+    processes = [
+        context.Process(target=_worker_main, args=(index, workers, queue), name=f'worker{index}', daemon=True)
+        for index, queue in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+
+    client = TelegramClient(bot.USERNAME, api_id=bot.API_ID, api_hash=bot.API_HASH)
+
+    @client.on(events.Raw)
+    async def forward(update):
+        try:
+            queues[shard_of(sender_of(update), workers)].put(update)
+        except Exception:
+            logging.exception('Failed to forward %s', type(update).__name__)
+
+    client.start(bot_token=bot.BOT_TOKEN)
+    logging.info('Receiving updates for %d workers', workers)
+    # SIGTERM (container stop) disconnects, so the workers are told to stop below
+    client.loop.add_signal_handler(signal.SIGTERM, lambda: client.loop.create_task(client.disconnect()))
+    try:
+        client.run_until_disconnected()
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            process.join(timeout=30)
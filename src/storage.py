@@ -0,0 +1,935 @@
+import csv
+import calendar
+import os
+import sqlite3
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+
+import columnar
+
+
+COLUMNS = ['Year', 'Month', 'Day', 'Count', 'USERNAME', 'FIRST_NAME', 'LAST_NAME']
+ADDRESS_COLUMNS = ['USER_ID', 'USERNAME', 'FIRST_NAME', 'LAST_NAME', 'Address']
+
+# (USERNAME, Year, Month, Day)
+Key = tuple[str, int, int, int]
+# arguments of `increment`: (USERNAME, FIRST_NAME, LAST_NAME, Year, Month, Day, Count)
+Change = tuple[Optional[str], Optional[str], Optional[str], int, int, int, int]
+
+
+def tutor_key(user_id: int, username: Optional[str]) -> str:
+    """
+    Returns the USERNAME the classes of a user are stored under: their
+    username, or `id:<user ID>` for users without one, so two tutors
+    without username never share rows.
+    """
+    return username or f'id:{user_id}'
+
+
+class MonthTotal(NamedTuple):
+    username: str
+    first_name: str
+    last_name: str
+    classes: int
+    days: int
+
+
+# (Year, Month) bounds of an export, inclusive
+Month = tuple[int, int]
+
+
+class _Month:
+    """
+    Rows and running totals of one month of an `AttendanceStore`.
+    """
+
+    __slots__ = ('rows', 'totals', 'dirty')
+
+    def __init__(self):
+        # (username, day) -> [count, first name, last name]
+        self.rows: dict[tuple[str, int], list] = {}
+        # username -> [classes, active days, first name, last name], kept up to date by _set
+        self.totals: dict[str, list] = {}
+        # changed since the partition was last written
+        self.dirty = False
+
+
+class AttendanceStore:
+    """
+    Class counts per tutor and day, persisted as a columnar snapshot with one
+    partition file per month plus an append-only log.
+
+    Every change appends one line to the log with the resulting count of the
+    affected day, so replaying the log over the snapshot is idempotent and a
+    crash in the middle of a compaction can not count a class twice. The log
+    is folded into the partitions of the changed months every
+    `compact_every` lines and when the store is opened or closed.
+
+    Months are read from their partition the first time they are needed and
+    at most `max_months` unchanged months are kept in memory. The CSV file
+    is never written; when there is no snapshot yet, it is imported once to
+    create it.
+
+    All public methods are thread safe, so they can be run in an executor.
+
+    Args:
+        path: path of the CSV file, e.g. `selected_days.csv`. The partitions
+            are kept next to it, in `selected_days/YYYY-MM.col`.
+        compact_every: amount of log lines that triggers a compaction.
+        max_months: amount of unchanged months kept in memory.
+    """
+
+    def __init__(self, path: Path, compact_every: int = 1000, max_months: int = 24):
+        self.path = Path(path)
+        self.log_path = self.path.with_suffix('.log')
+        self.snapshot_dir = self.path.with_suffix('')
+        self.compact_every = compact_every
+        self.max_months = max_months
+        # (year, month) -> rows, least recently used first
+        self._months: OrderedDict[tuple[int, int], _Month] = OrderedDict()
+        # (year, month) -> rows of its partition
+        self._sizes: dict[tuple[int, int], int] = {}
+        self._log_lines = 0
+        self._log = None
+        self._lock = threading.RLock()
+
+        if not self.snapshot_dir.is_dir():
+            self._import_csv()
+        for partition in self.snapshot_dir.glob('*.col'):
+            year, month, size = columnar.read_header(partition)
+            self._sizes[(year, month)] = size
+        self._load(self.log_path)
+        self.compact()
+
+    @staticmethod
+    def _key(username: Optional[str], year, month, day) -> Key:
+        return (username or '', int(year), int(month), int(day))
+
+    def _partition_path(self, year: int, month: int) -> Path:
+        return self.snapshot_dir / f'{year:04d}-{month:02d}.col'
+
+    def _import_csv(self) -> None:
+        """
+        Creates the snapshot from the CSV file, in a temporary directory that
+        is renamed once complete.
+        """
+        self._load(self.path)
+        final_dir, self.snapshot_dir = self.snapshot_dir, self.snapshot_dir.with_suffix('.tmp')
+        if self.snapshot_dir.is_dir():
+            shutil.rmtree(self.snapshot_dir)
+        self.snapshot_dir.mkdir(parents=True)
+        self._write_partitions()
+        os.replace(self.snapshot_dir, final_dir)
+        self.snapshot_dir = final_dir
+        self._months.clear()
+
+    def _month(self, year: int, month: int) -> _Month:
+        """
+        Returns the rows of a month, reading them from its partition if they
+        are not in memory.
+        """
+        key = (year, month)
+        rows = self._months.get(key)
+        if rows is not None:
+            self._months.move_to_end(key)
+            return rows
+
+        rows = self._months[key] = _Month()
+        if key in self._sizes:
+            with columnar.Partition(self._partition_path(year, month)) as partition:
+                for username, first_name, last_name, day, count in partition.rows():
+                    self._set((username, year, month, day), count, first_name, last_name, rows)
+            rows.dirty = False
+
+        clean = [other for other, loaded in self._months.items() if not loaded.dirty and other != key]
+        for other in clean[:len(self._months) - self.max_months]:
+            del self._months[other]
+        return rows
+
+    def _load(self, path: Path) -> None:
+        if not path.is_file():
+            return
+        with open(path, mode='r', encoding='utf-8', newline='') as file:
+            for row in csv.DictReader(file):
+                try:
+                    key = self._key(row['USERNAME'], row['Year'], row['Month'], row['Day'])
+                    count = int(row['Count'])
+                except (TypeError, ValueError):
+                    # skip lines truncated by a crash
+                    continue
+                self._set(key, count, row['FIRST_NAME'], row['LAST_NAME'])
+
+    def _entry(self, key: Key) -> Optional[list]:
+        username, year, month, day = key
+        return self._month(year, month).rows.get((username, day))
+
+    def _set(
+        self,
+        key: Key,
+        count: int,
+        first_name: Optional[str],
+        last_name: Optional[str],
+        rows: Optional[_Month] = None
+    ) -> None:
+        username, year, month, day = key
+        rows = rows or self._month(year, month)
+        entry = rows.rows.get((username, day))
+        previous = entry[0] if entry else 0
+        count = max(count, 0)
+        if count == 0:
+            rows.rows.pop((username, day), None)
+        elif previous:
+            entry[0] = count
+        else:
+            rows.rows[(username, day)] = [count, first_name or '', last_name or '']
+
+        if count != previous:
+            rows.dirty = True
+            total = rows.totals.setdefault(username, [0, 0, first_name or '', last_name or ''])
+            total[0] += count - previous
+            total[1] += bool(count) - bool(previous)
+            if not total[1]:
+                del rows.totals[username]
+
+    def _append_log(self, key: Key, flush: bool = True) -> None:
+        if self._log is None:
+            write_header = not (self.log_path.is_file() and self.log_path.stat().st_size > 0)
+            self._log = open(self.log_path, mode='a', encoding='utf-8', newline='')
+            self._log_writer = csv.writer(self._log)
+            if write_header:
+                self._log_writer.writerow(COLUMNS)
+
+        self._log_writer.writerow(self._as_list(key))
+        if flush:
+            self._log.flush()
+        self._log_lines += 1
+
+    def _as_list(self, key: Key) -> list:
+        username, year, month, day = key
+        count, first_name, last_name = self._entry(key) or (0, '', '')
+        return [year, month, day, count, username, first_name, last_name]
+
+    def increment(
+        self,
+        username: Optional[str],
+        first_name: Optional[str],
+        last_name: Optional[str],
+        year: int,
+        month: int,
+        day: int,
+        count: int = 1
+    ) -> int:
+        """
+        Adds `count` classes to a day of a tutor.
+
+        Returns:
+            The amount of classes registered for that day after the change.
+        """
+        key = self._key(username, year, month, day)
+        with self._lock:
+            entry = self._entry(key)
+            self._set(key, (entry[0] if entry else 0) + count, first_name, last_name)
+            self._append_log(key)
+
+            if self._log_lines >= self.compact_every:
+                self.compact()
+
+            entry = self._entry(key)
+            return entry[0] if entry else 0
+
+    def increment_many(self, changes: list[Change]) -> None:
+        """
+        Applies several increments with a single write to the log, which is
+        synced to disk before returning.
+        """
+        with self._lock:
+            for username, first_name, last_name, year, month, day, count in changes:
+                key = self._key(username, year, month, day)
+                entry = self._entry(key)
+                self._set(key, (entry[0] if entry else 0) + count, first_name, last_name)
+                self._append_log(key, flush=False)
+
+            if self._log is not None:
+                self._log.flush()
+                os.fsync(self._log.fileno())
+            if self._log_lines >= self.compact_every:
+                self.compact()
+
+    def day_counts(self, username: Optional[str], year: int, month: int) -> dict[int, int]:
+        """
+        Returns the amount of classes per day of a tutor in the given month.
+        """
+        counts = {}
+        with self._lock:
+            rows = self._month(int(year), int(month)).rows
+            for day in range(1, calendar.monthrange(int(year), int(month))[1] + 1):
+                entry = rows.get((username or '', day))
+                if entry is not None:
+                    counts[day] = entry[0]
+        return counts
+
+    def row_count(self) -> int:
+        """
+        Returns the amount of (tutor, day) rows.
+        """
+        with self._lock:
+            loaded = sum(len(rows.rows) for rows in self._months.values())
+            return loaded + sum(size for key, size in self._sizes.items() if key not in self._months)
+
+    def month_totals(self, year: int, month: int) -> list[MonthTotal]:
+        """
+        Returns the amount of classes and active days of every tutor in the
+        given month, from running totals instead of scanning the rows.
+        """
+        with self._lock:
+            totals = [
+                MonthTotal(username, first_name, last_name, classes, days)
+                for username, (classes, days, first_name, last_name)
+                in self._month(int(year), int(month)).totals.items()
+            ]
+        return sorted(totals)
+
+    def _write_partitions(self) -> None:
+        for (year, month), rows in self._months.items():
+            if not rows.dirty:
+                continue
+            path = self._partition_path(year, month)
+            if rows.rows:
+                self._sizes[(year, month)] = columnar.write_partition(path, year, month, (
+                    (username, first_name, last_name, day, count)
+                    for (username, day), (count, first_name, last_name) in rows.rows.items()
+                ))
+            else:
+                self._sizes.pop((year, month), None)
+                if path.is_file():
+                    path.unlink()
+            rows.dirty = False
+
+    def compact(self) -> None:
+        """
+        Writes the partitions of the changed months and truncates the log.
+        """
+        with self._lock:
+            self._write_partitions()
+
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            if self.log_path.is_file():
+                self.log_path.unlink()
+            self._log_lines = 0
+
+    def stream(
+        self,
+        username: Optional[str] = None,
+        first: Optional[Month] = None,
+        last: Optional[Month] = None,
+        all_tutors: bool = False
+    ) -> Iterator[list]:
+        """
+        Yields the rows with the layout of `COLUMNS` of a tutor, optionally
+        between two months, read in place from the partitions of the months
+        in the range, or from memory for the months changed since the last
+        compaction.
+
+        Args:
+            username: key of the tutor, see `tutor_key`.
+            first: first month of the range, if any.
+            last: last month of the range, if any.
+            all_tutors: yield the rows of every tutor instead, ignoring
+                `username`.
+
+        Raises:
+            ValueError: without `username` nor `all_tutors`.
+        """
+        if username is None and not all_tutors:
+            raise ValueError('stream needs a username or all_tutors')
+        username = None if all_tutors else username
+        with self._lock:
+            months = sorted(month for month in set(self._sizes) | set(self._months)
+                            if (first is None or month >= first) and (last is None or month <= last))
+            # the partitions of the changed months are outdated, copy their rows
+            # instead of compacting on every export
+            changed = {
+                month: sorted(
+                    (row_username, first_name, last_name, day, count)
+                    for (row_username, day), (count, first_name, last_name) in self._months[month].rows.items()
+                    if username is None or row_username == username
+                )
+                for month in months if month in self._months and self._months[month].dirty
+            }
+            months = [month for month in months if month in changed or month in self._sizes]
+        for year, month in months:
+            if (year, month) in changed:
+                for row_username, first_name, last_name, day, count in changed[(year, month)]:
+                    yield [year, month, day, count, row_username, first_name, last_name]
+                continue
+            try:
+                # a later compaction replaces the partition, the mapping keeps the old one
+                partition = columnar.Partition(self._partition_path(year, month))
+            except FileNotFoundError:
+                continue
+            with partition:
+                for row_username, first_name, last_name, day, count in partition.rows(username):
+                    yield [year, month, day, count, row_username, first_name, last_name]
+
+    def close(self) -> None:
+        """
+        Compacts the store, leaving only the partitions on disk.
+        """
+        self.compact()
+
+
+class WriteBehindAttendance:
+    """
+    Attendance store wrapper that keeps increments in memory and writes them
+    to the wrapped store in batches.
+
+    Reads of a tutor's month include the pending increments, the rest of the
+    reads flush them first. `flush` is also called when `max_pending`
+    increments are waiting, and must be called periodically and on shutdown.
+
+    `stored_rows` is the amount of rows of the store after the last write,
+    so it can be read from the event loop without touching the disk.
+
+    Args:
+        store: `AttendanceStore` or `SQLiteAttendanceStore`.
+        max_pending: amount of pending increments that triggers a flush.
+    """
+
+    def __init__(self, store, max_pending: int = 100):
+        self.store = store
+        self.max_pending = max_pending
+        # key -> [count, first name, last name]
+        self._pending: dict[Key, list] = {}
+        self._events = 0
+        # held while flushing, so reads never miss the batch being written
+        self._lock = threading.RLock()
+        self.stored_rows = store.row_count()
+
+    def increment(
+        self,
+        username: Optional[str],
+        first_name: Optional[str],
+        last_name: Optional[str],
+        year: int,
+        month: int,
+        day: int,
+        count: int = 1
+    ) -> int:
+        key = (username or '', int(year), int(month), int(day))
+        with self._lock:
+            pending = self._pending.setdefault(key, [0, first_name, last_name])
+            pending[0] += count
+            self._events += 1
+            current = self.store.day_counts(username, year, month).get(int(day), 0) + pending[0]
+            if self._events >= self.max_pending:
+                self.flush()
+        return max(current, 0)
+
+    def increment_many(self, changes: list[Change]) -> None:
+        """
+        Writes the pending increments and `changes` to the store in a single
+        batch, e.g. a whole calendar draft.
+        """
+        with self._lock:
+            pending = [
+                (username, first_name, last_name, year, month, day, count)
+                for (username, year, month, day), (count, first_name, last_name) in self._pending.items()
+                if count
+            ]
+            self.store.increment_many(pending + list(changes))
+            self._pending = {}
+            self._events = 0
+            self.stored_rows = self.store.row_count()
+
+    def flush(self) -> int:
+        """
+        Writes the pending increments to the store.
+
+        Returns:
+            The amount of days written.
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            changes = [
+                (username, first_name, last_name, year, month, day, count)
+                for (username, year, month, day), (count, first_name, last_name) in self._pending.items()
+                if count
+            ]
+            self.store.increment_many(changes)
+            self._pending = {}
+            self._events = 0
+            self.stored_rows = self.store.row_count()
+            return len(changes)
+
+    def day_counts(self, username: Optional[str], year: int, month: int) -> dict[int, int]:
+        with self._lock:
+            counts = self.store.day_counts(username, year, month)
+            prefix = (username or '', int(year), int(month))
+            for key, (count, _, _) in self._pending.items():
+                if key[:3] == prefix:
+                    counts[key[3]] = counts.get(key[3], 0) + count
+                    if counts[key[3]] <= 0:
+                        del counts[key[3]]
+            return dict(sorted(counts.items()))
+
+    def row_count(self) -> int:
+        return self.store.row_count()
+
+    def pending(self) -> int:
+        """
+        Returns the amount of buffered increments.
+        """
+        return self._events
+
+    def month_totals(self, year: int, month: int) -> list[MonthTotal]:
+        self.flush()
+        return self.store.month_totals(year, month)
+
+    def compact(self) -> None:
+        self.flush()
+        self.store.compact()
+        self.stored_rows = self.store.row_count()
+
+    def stream(
+        self,
+        username: Optional[str] = None,
+        first: Optional[Month] = None,
+        last: Optional[Month] = None,
+        all_tutors: bool = False
+    ) -> Iterator[list]:
+        self.flush()
+        return self.store.stream(username, first, last, all_tutors)
+
+    def close(self) -> None:
+        self.flush()
+        self.store.close()
+
+
+class AddressBook:
+    """
+    USDT addresses of the tutors keyed by user ID, loaded once from a CSV
+    file with the layout of `ADDRESS_COLUMNS`.
+
+    Every update rewrites the file to a temporary one and atomically replaces
+    the original, so a crash can never leave it half written.
+
+    Args:
+        path: path of the CSV file, e.g. `crypto_addresses.csv`.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        # user_id -> row with the layout of ADDRESS_COLUMNS
+        self._rows: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+        if self.path.is_file():
+            with open(self.path, mode='r', encoding='utf-8', newline='') as file:
+                for row in csv.reader(file):
+                    if len(row) < len(ADDRESS_COLUMNS) or row[0] == ADDRESS_COLUMNS[0]:
+                        continue
+                    self._rows[row[0]] = row[:len(ADDRESS_COLUMNS)]
+
+    def get(self, user_id: int) -> Optional[str]:
+        """
+        Returns the address of the user, if any.
+        """
+        row = self._rows.get(str(user_id))
+        return row[4] if row else None
+
+    def upsert(
+        self,
+        user_id: int,
+        username: Optional[str],
+        first_name: Optional[str],
+        last_name: Optional[str],
+        address: str
+    ) -> None:
+        """
+        Sets the address of the user, adding a row if it is new.
+        """
+        with self._lock:
+            row = self._rows.get(str(user_id))
+            if row is not None:
+                row[4] = address
+            else:
+                self._rows[str(user_id)] = [user_id, username, first_name, last_name, address]
+            self._write()
+
+    def _write(self) -> None:
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, mode='w', encoding='utf-8', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(ADDRESS_COLUMNS)
+            writer.writerows(self._rows.values())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def rows(self) -> Iterator[list]:
+        """
+        Yields the rows of the book with the layout of `ADDRESS_COLUMNS`.
+        """
+        yield from list(self._rows.values())
+
+    def by_username(self) -> dict[str, str]:
+        """
+        Returns the address of every tutor keyed by the username their
+        classes are stored under, see `tutor_key`.
+        """
+        return {tutor_key(row[0], row[1]): row[4] for row in self.rows()}
+
+    def close(self) -> None:
+        pass
+
+
+def connect(database: Path) -> sqlite3.Connection:
+    """
+    Opens a SQLite database in WAL mode, so readers don't block the writer,
+    shareable between the threads of the I/O pool.
+    """
+    connection = sqlite3.connect(
+        database, timeout=30, isolation_level=None, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+class SQLiteAttendanceStore:
+    """
+    `AttendanceStore` backed by a SQLite table with a unique index on
+    (USERNAME, Year, Month, Day), where every change is a single upsert.
+    Monthly totals per tutor are kept in their own table, updated in the
+    same transaction.
+
+    Args:
+        connection: connection returned by `connect`, not shared with other stores.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self._db = connection
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS selected_days ('
+                'Year INTEGER NOT NULL, Month INTEGER NOT NULL, Day INTEGER NOT NULL, '
+                'Count INTEGER NOT NULL, USERNAME TEXT NOT NULL, FIRST_NAME TEXT, LAST_NAME TEXT)'
+            )
+            self._db.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS selected_days_key '
+                'ON selected_days (USERNAME, Year, Month, Day)'
+            )
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS monthly_totals ('
+                'Year INTEGER NOT NULL, Month INTEGER NOT NULL, USERNAME TEXT NOT NULL, '
+                'FIRST_NAME TEXT, LAST_NAME TEXT, Classes INTEGER NOT NULL, Days INTEGER NOT NULL, '
+                'PRIMARY KEY (Year, Month, USERNAME))'
+            )
+            if self._db.execute('SELECT 1 FROM monthly_totals LIMIT 1').fetchone() is None:
+                self._rebuild_totals()
+
+    def _rebuild_totals(self) -> None:
+        self._db.execute('DELETE FROM monthly_totals')
+        self._db.execute(
+            'INSERT INTO monthly_totals (Year, Month, USERNAME, FIRST_NAME, LAST_NAME, Classes, Days) '
+            'SELECT Year, Month, USERNAME, MIN(FIRST_NAME), MIN(LAST_NAME), SUM(Count), COUNT(*) '
+            'FROM selected_days GROUP BY Year, Month, USERNAME'
+        )
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM selected_days LIMIT 1').fetchone() is None
+
+    def import_csv(self, path: Path, only_if_empty: bool = False) -> bool:
+        """
+        Loads the rows of a CSV file with the layout of `COLUMNS`, see
+        `import_rows`.
+        """
+        with open(path, mode='r', encoding='utf-8', newline='') as file:
+            return self.import_rows(
+                ([row.get(column) for column in COLUMNS] for row in csv.DictReader(file)), only_if_empty)
+
+    def import_rows(self, rows, only_if_empty: bool = False) -> bool:
+        """
+        Loads rows with the layout of `COLUMNS` in a single transaction,
+        adding their counts to those already stored.
+
+        Args:
+            rows: rows to load.
+            only_if_empty: skip the import if the table has rows when the
+                transaction starts, so processes opening the same database
+                at once import the rows only once.
+
+        Returns:
+            Whether the rows were imported.
+        """
+        valid_rows = []
+        for row in rows:
+            try:
+                year, month, day, count, username, first_name, last_name = row
+                valid_rows.append((int(year), int(month), int(day), int(count), username or '', first_name, last_name))
+            except (TypeError, ValueError):
+                continue
+        rows = valid_rows
+
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                if only_if_empty and self._db.execute('SELECT 1 FROM selected_days LIMIT 1').fetchone() is not None:
+                    self._db.execute('ROLLBACK')
+                    return False
+                self._db.executemany(
+                    'INSERT INTO selected_days (Year, Month, Day, Count, USERNAME, FIRST_NAME, LAST_NAME) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (USERNAME, Year, Month, Day) DO UPDATE SET Count = Count + excluded.Count',
+                    rows
+                )
+                self._rebuild_totals()
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return True
+
+    def increment(
+        self,
+        username: Optional[str],
+        first_name: Optional[str],
+        last_name: Optional[str],
+        year: int,
+        month: int,
+        day: int,
+        count: int = 1
+    ) -> int:
+        key = (username or '', int(year), int(month), int(day))
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                current = self._apply(key, count, first_name or '', last_name or '')
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return current
+
+    def increment_many(self, changes: list[Change]) -> None:
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                for username, first_name, last_name, year, month, day, count in changes:
+                    key = (username or '', int(year), int(month), int(day))
+                    self._apply(key, count, first_name or '', last_name or '')
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def _apply(self, key: Key, count: int, first_name: str, last_name: str) -> int:
+        where = 'WHERE USERNAME = ? AND Year = ? AND Month = ? AND Day = ?'
+        row = self._db.execute(f'SELECT Count FROM selected_days {where}', key).fetchone()
+        previous = row[0] if row else 0
+
+        self._db.execute(
+            'INSERT INTO selected_days (Year, Month, Day, Count, USERNAME, FIRST_NAME, LAST_NAME) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (USERNAME, Year, Month, Day) DO UPDATE SET Count = Count + excluded.Count',
+            (key[1], key[2], key[3], count, key[0], first_name, last_name)
+        )
+        current = previous + count
+        if current <= 0:
+            self._db.execute(f'DELETE FROM selected_days {where}', key)
+            current = 0
+
+        if current != previous:
+            self._db.execute(
+                'INSERT INTO monthly_totals (Year, Month, USERNAME, FIRST_NAME, LAST_NAME, Classes, Days) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (Year, Month, USERNAME) DO UPDATE SET '
+                'Classes = Classes + excluded.Classes, Days = Days + excluded.Days',
+                (key[1], key[2], key[0], first_name, last_name,
+                 current - previous, bool(current) - bool(previous))
+            )
+            self._db.execute(
+                'DELETE FROM monthly_totals WHERE Year = ? AND Month = ? AND USERNAME = ? AND Days <= 0',
+                (key[1], key[2], key[0])
+            )
+        return current
+
+    def day_counts(self, username: Optional[str], year: int, month: int) -> dict[int, int]:
+        with self._lock:
+            return dict(self._db.execute(
+                'SELECT Day, Count FROM selected_days WHERE USERNAME = ? AND Year = ? AND Month = ? ORDER BY Day',
+                (username or '', int(year), int(month))
+            ))
+
+    def row_count(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM selected_days').fetchone()[0]
+
+    def month_totals(self, year: int, month: int) -> list[MonthTotal]:
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT USERNAME, FIRST_NAME, LAST_NAME, Classes, Days FROM monthly_totals '
+                'WHERE Year = ? AND Month = ? ORDER BY USERNAME',
+                (int(year), int(month))
+            ).fetchall()
+        return [MonthTotal(*row) for row in rows]
+
+    def compact(self) -> None:
+        with self._lock:
+            self._db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def stream(
+        self,
+        username: Optional[str] = None,
+        first: Optional[Month] = None,
+        last: Optional[Month] = None,
+        all_tutors: bool = False,
+        page_size: int = 5000
+    ) -> Iterator[list]:
+        """
+        Yields the rows like `AttendanceStore.stream`, fetched in pages of
+        `page_size` along the unique index so the lock is never held between
+        two rows.
+        """
+        conditions, params = [], []
+        if username is None and not all_tutors:
+            raise ValueError('stream needs a username or all_tutors')
+        if not all_tutors:
+            conditions.append('USERNAME = ?')
+            params.append(username)
+        if first is not None:
+            conditions.append('Year * 100 + Month >= ?')
+            params.append(first[0] * 100 + first[1])
+        if last is not None:
+            conditions.append('Year * 100 + Month <= ?')
+            params.append(last[0] * 100 + last[1])
+        query = (
+            'SELECT Year, Month, Day, Count, USERNAME, FIRST_NAME, LAST_NAME FROM selected_days '
+            'WHERE (USERNAME, Year, Month, Day) > (?, ?, ?, ?) '
+            + ''.join(f'AND {condition} ' for condition in conditions)
+            + 'ORDER BY USERNAME, Year, Month, Day LIMIT ?'
+        )
+        after = ('', 0, 0, 0)
+        while True:
+            with self._lock:
+                rows = self._db.execute(query, (*after, *params, page_size)).fetchall()
+            for row in rows:
+                yield list(row)
+            if len(rows) < page_size:
+                return
+            year, month, day, _, last_username, _, _ = rows[-1]
+            after = (last_username, year, month, day)
+
+    def close(self) -> None:
+        self.compact()
+
+
+class SQLiteAddressBook:
+    """
+    `AddressBook` backed by a SQLite table keyed by user ID.
+
+    Args:
+        connection: connection returned by `connect`, not shared with other stores.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self._db = connection
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS crypto_addresses ('
+                'USER_ID INTEGER PRIMARY KEY, USERNAME TEXT, FIRST_NAME TEXT, LAST_NAME TEXT, '
+                'Address TEXT NOT NULL)'
+            )
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM crypto_addresses LIMIT 1').fetchone() is None
+
+    def import_csv(self, path: Path) -> None:
+        """
+        Loads the rows of a CSV file with the layout of `ADDRESS_COLUMNS`.
+        """
+        for row in AddressBook(path).rows():
+            self.upsert(*row)
+
+    def get(self, user_id: int) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute(
+                'SELECT Address FROM crypto_addresses WHERE USER_ID = ?', (int(user_id),)).fetchone()
+        return row[0] if row else None
+
+    def upsert(
+        self,
+        user_id: int,
+        username: Optional[str],
+        first_name: Optional[str],
+        last_name: Optional[str],
+        address: str
+    ) -> None:
+        with self._lock:
+            self._db.execute(
+                'INSERT INTO crypto_addresses (USER_ID, USERNAME, FIRST_NAME, LAST_NAME, Address) '
+                'VALUES (?, ?, ?, ?, ?) ON CONFLICT (USER_ID) DO UPDATE SET Address = excluded.Address',
+                (int(user_id), username, first_name, last_name, address)
+            )
+
+    def rows(self) -> Iterator[list]:
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT USER_ID, USERNAME, FIRST_NAME, LAST_NAME, Address FROM crypto_addresses').fetchall()
+        for row in rows:
+            yield list(row)
+
+    def by_username(self) -> dict[str, str]:
+        return {tutor_key(row[0], row[1]): row[4] for row in self.rows()}
+
+    def close(self) -> None:
+        pass
+
+
+def open_storage(
+    backend: str,
+    attendance_path: Path,
+    addresses_path: Path,
+    database: Path,
+    compact_every: int = 1000
+):
+    """
+    Opens the attendance store and the address book of a backend.
+
+    Args:
+        backend: 'csv' to keep the data in the CSV files (the attendance in
+            the partitions of `AttendanceStore`), 'sqlite' to keep it in
+            `database`, importing the files the first time.
+        attendance_path: path of `selected_days.csv`.
+        addresses_path: path of `crypto_addresses.csv`.
+        database: path of the SQLite database.
+        compact_every: lines of the attendance log that trigger a compaction.
+
+    Returns:
+        The attendance store and the address book.
+    """
+    if backend == 'csv':
+        return AttendanceStore(attendance_path, compact_every), AddressBook(addresses_path)
+    if backend != 'sqlite':
+        raise ValueError(f'Unknown storage backend: {backend}')
+
+    # a connection each, so a transaction of one store never includes writes of the other
+    attendance = SQLiteAttendanceStore(connect(database))
+    addresses = SQLiteAddressBook(connect(database))
+    if attendance.is_empty() and Path(attendance_path).with_suffix('').is_dir():
+        # the csv backend was used before, its partitions are more recent than the CSV file
+        attendance.import_rows(AttendanceStore(attendance_path, compact_every).stream(all_tutors=True), only_if_empty=True)
+    elif attendance.is_empty() and Path(attendance_path).is_file():
+        attendance.import_csv(attendance_path, only_if_empty=True)
+    if addresses.is_empty() and Path(addresses_path).is_file():
+        addresses.import_csv(addresses_path)
+    return attendance, addresses
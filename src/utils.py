@@ -1,61 +1,116 @@
-from typing import Iterator
-from asyncio import wait
+import asyncio
+from collections import deque
+from typing import AsyncIterator
+from asyncio import ensure_future, get_running_loop, sleep, wait
 from asyncio.tasks import FIRST_COMPLETED
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED
 from typing import Union, Optional
 from pathlib import Path
 
 
 
+from telethon.errors import FloodWaitError
 from telethon.tl.custom import Message
 
 
+def media_path(root: Path, msg: Message) -> Path:
+    """
+    Returns where `download_files` stores the file of a message, in its own
+    directory so files with the same name don't overwrite each other.
+    """
+    return root / str(msg.id) / (msg.file.name or f'{msg.id}{msg.file.ext or ""}')
+
+
 async def download_files(
     msgs: list[Message],
     conc_max: int = 3,
-    root: Union[Path, None] = None
-) -> Iterator[Path]:
+    root: Union[Path, None] = None,
+    conc_limit: Optional[int] = None,
+    retries: int = 3
+) -> AsyncIterator[tuple[Message, Path]]:
     """
     Downloads the file if present for each message.
 
+    The amount of concurrent downloads starts at `conc_max` and adapts to the
+    connection: it grows by one every time as many downloads finish, up to
+    `conc_limit`, and is halved when Telegram asks to wait or a download
+    fails. FloodWaits pause new downloads for the requested time and failed
+    downloads are retried up to `retries` times.
+
     Args:
         msgs: list of messages from where download the files.
-        conc_max: max amount of files to be downloaded concurrently.
-        root: root path where store file downloaded.
-    
+        conc_max: amount of files downloaded concurrently at the start.
+        root: root path where store file downloaded, see `media_path`.
+        conc_limit: max amount of files downloaded concurrently, `conc_max`
+            by default.
+        retries: attempts per file before giving up.
+
     Returns:
-        Yields the path of every file that is downloaded.
+        Yields every message and the path of its file as soon as it is
+        downloaded.
     """
     root = root or Path('./')
+    conc_limit = max(conc_limit or conc_max, conc_max)
+    loop = get_running_loop()
+
+    limit = float(conc_max)
+    queue = deque((m, 0) for m in msgs)
+    # download task -> (message, failed attempts)
+    pending = {}
+    resume_at = 0.0
+    try:
+        while queue or pending:
+            # fill the pending set with tasks until reach the limit
+            while queue and len(pending) < int(limit) and loop.time() >= resume_at:
+                m, attempts = queue.popleft()
+                pending[ensure_future(m.download_media(file=media_path(root, m)))] = (m, attempts)
+
+            if not pending:
+                await sleep(resume_at - loop.time())
+                continue
+
+            done, _ = await wait(pending, return_when=FIRST_COMPLETED)
+            for task in done:
+                m, attempts = pending.pop(task)
+                try:
+                    path = task.result()
+                except FloodWaitError as e:
+                    limit = max(1.0, limit / 2)
+                    resume_at = loop.time() + e.seconds
+                    queue.appendleft((m, attempts))
+                except (OSError, asyncio.TimeoutError):
+                    if attempts + 1 >= retries:
+                        raise
+                    limit = max(1.0, limit / 2)
+                    queue.appendleft((m, attempts + 1))
+                else:
+                    limit = min(float(conc_limit), limit + 1 / limit)
+                    if path is not None:
+                        yield m, Path(path)
+    finally:
+        for task in pending:
+            task.cancel()
+
 
-    next_msg_index = 0
-    pending = set()
-    while next_msg_index < len(msgs) or pending:
-        # fill the pending set with tasks until reach conc_max
-        while len(pending) < conc_max and next_msg_index < len(msgs):
-            try:
-                m = msgs[next_msg_index]
-            except IndexError:
-                pass
-            else:
-                pending.add(m.download_media(file=root / (m.file.name or 'no_name')))
-                next_msg_index += 1
-        
-        if pending:
-            done, pending = await wait(pending, return_when=FIRST_COMPLETED)
-
-            if done and (path := await done.pop()) is not None:
-                yield Path(path)
-
-
-def add_to_zip(zip: Path, file: Path) -> None:
+def add_to_zip(
+    zip: Union[Path, ZipFile],
+    file: Path,
+    compression: int = ZIP_STORED,
+    arcname: Optional[str] = None
+) -> None:
     """
     Appends a file to a zip file.
 
     Args:
-        zip: the zip file path.
+        zip: the zip file path, or a ZipFile already open for writing, which
+            avoids reopening it for every file.
         file: the path to the file that must be added.
+        compression: zipfile compression method, e.g. ZIP_DEFLATED.
+        arcname: name of the file inside the zip, the name of `file` by default.
     """
+    if isinstance(zip, ZipFile):
+        zip.write(file, arcname or file.name, compress_type=compression)
+        return
     flag = 'a' if zip.is_file() else 'x'
-    with ZipFile(zip, flag) as zfile:
-        zfile.write(file, file.name)
+    with ZipFile(zip, flag, compression=compression) as zfile:
+        zfile.write(file, arcname or file.name)
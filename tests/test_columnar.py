@@ -0,0 +1,80 @@
+import pytest
+
+from columnar import MAX_COUNT, Partition, read_header, write_partition
+
+
+ROWS = [
+    ('bob', 'Bob', 'B', 3, 2),
+    ('alice', 'Alice', 'A', 5, 1),
+    ('alice', 'Alice', 'A', 1, 4),
+    ('', 'No', 'Username', 2, 1),
+    ('bobby', 'Bobby', '', 7, 3),
+    ('álvaro', 'Álvaro', 'Ñ', 9, 1),
+]
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / '2024-05.col'
+    assert write_partition(path, 2024, 5, ROWS) == len(ROWS)
+
+    assert read_header(path) == (2024, 5, len(ROWS))
+    with Partition(path) as partition:
+        assert (partition.year, partition.month, partition.size) == (2024, 5, len(ROWS))
+        assert list(partition.rows()) == sorted(
+            (username, first, last, day, count) for username, first, last, day, count in ROWS)
+
+
+def test_rows_of_a_tutor(tmp_path):
+    path = tmp_path / '2024-05.col'
+    write_partition(path, 2024, 5, ROWS)
+
+    with Partition(path) as partition:
+        assert list(partition.rows('alice')) == [('alice', 'Alice', 'A', 1, 4), ('alice', 'Alice', 'A', 5, 1)]
+        # a prefix of another username
+        assert list(partition.rows('bob')) == [('bob', 'Bob', 'B', 3, 2)]
+        assert list(partition.rows('')) == [('', 'No', 'Username', 2, 1)]
+        assert list(partition.rows('carol')) == []
+
+
+def test_tutor_with_several_names(tmp_path):
+    path = tmp_path / '2024-05.col'
+    write_partition(path, 2024, 5, [('alice', 'Alice', 'A', 1, 1), ('alice', 'Alicia', 'A', 2, 1)])
+
+    with Partition(path) as partition:
+        assert [row[3] for row in partition.rows('alice')] == [1, 2]
+
+
+def test_wide_user_index(tmp_path):
+    path = tmp_path / '2024-05.col'
+    rows = [(f'tutor{i}', '', '', 1 + i % 28, 1) for i in range(0x10001)]
+    write_partition(path, 2024, 5, rows)
+
+    with Partition(path) as partition:
+        assert partition.size == len(rows)
+        assert list(partition.rows('tutor65536')) == [('tutor65536', '', '', 1 + 0x10000 % 28, 1)]
+
+
+def test_counts_are_capped(tmp_path):
+    path = tmp_path / '2024-05.col'
+    write_partition(path, 2024, 5, [('alice', '', '', 1, MAX_COUNT + 10)])
+
+    with Partition(path) as partition:
+        assert list(partition.rows()) == [('alice', '', '', 1, MAX_COUNT)]
+
+
+def test_empty_partition(tmp_path):
+    path = tmp_path / '2024-05.col'
+    write_partition(path, 2024, 5, [])
+
+    with Partition(path) as partition:
+        assert list(partition.rows()) == []
+
+
+def test_not_a_partition(tmp_path):
+    path = tmp_path / '2024-05.col'
+    path.write_bytes(b'Year,Month,Day,Count,USERNAME,FIRST_NAME,LAST_NAME\n')
+
+    with pytest.raises(ValueError):
+        read_header(path)
+    with pytest.raises(ValueError):
+        Partition(path)
@@ -0,0 +1,148 @@
+import csv
+import shutil
+
+import pytest
+
+from storage import COLUMNS, AttendanceStore, open_storage, tutor_key
+
+
+def write_csv(path, rows):
+    with open(path, mode='w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(COLUMNS)
+        writer.writerows(rows)
+
+
+def test_import_csv(tmp_path):
+    path = tmp_path / 'selected_days.csv'
+    write_csv(path, [
+        [2024, 5, 3, 2, 'alice', 'Alice', 'A'],
+        [2024, 5, 4, 1, 'alice', 'Alice', 'A'],
+        [2024, 6, 1, 3, 'bob', 'Bob', 'B'],
+        [2024, 6, 2, 1, '', 'No', 'Username'],
+    ])
+
+    store = AttendanceStore(path)
+
+    assert sorted(partition.name for partition in (tmp_path / 'selected_days').iterdir()) == [
+        '2024-05.col', '2024-06.col']
+    assert store.day_counts('alice', 2024, 5) == {3: 2, 4: 1}
+    assert store.day_counts(None, 2024, 6) == {2: 1}
+    assert store.row_count() == 4
+    assert [total[:4] for total in store.month_totals(2024, 6)] == [('', 'No', 'Username', 1), ('bob', 'Bob', 'B', 3)]
+    assert list(store.stream(all_tutors=True)) == [
+        [2024, 5, 3, 2, 'alice', 'Alice', 'A'],
+        [2024, 5, 4, 1, 'alice', 'Alice', 'A'],
+        [2024, 6, 2, 1, '', 'No', 'Username'],
+        [2024, 6, 1, 3, 'bob', 'Bob', 'B'],
+    ]
+
+
+def test_import_csv_only_once(tmp_path):
+    path = tmp_path / 'selected_days.csv'
+    write_csv(path, [[2024, 5, 3, 2, 'alice', 'Alice', 'A']])
+    AttendanceStore(path).close()
+
+    # the partitions are the data from now on
+    write_csv(path, [[2024, 5, 3, 9, 'alice', 'Alice', 'A']])
+    assert AttendanceStore(path).day_counts('alice', 2024, 5) == {3: 2}
+
+
+def test_import_csv_columns_in_any_order(tmp_path):
+    path = tmp_path / 'selected_days.csv'
+    with open(path, mode='w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['USERNAME', 'FIRST_NAME', 'LAST_NAME', 'Year', 'Month', 'Day', 'Count'])
+        writer.writerow(['alice', 'Alice', 'A', 2024, 5, 3, 2])
+
+    assert AttendanceStore(path).day_counts('alice', 2024, 5) == {3: 2}
+
+
+def test_log_replay_after_crash(tmp_path):
+    path = tmp_path / 'selected_days.csv'
+    store = AttendanceStore(path, compact_every=1000)
+    store.increment('alice', 'Alice', 'A', 2024, 5, 3)
+    store.increment('alice', 'Alice', 'A', 2024, 5, 3)
+    store.increment_many([
+        ('bob', 'Bob', 'B', 2024, 5, 4, 1),
+        ('alice', 'Alice', 'A', 2024, 6, 1, 1),
+        ('alice', 'Alice', 'A', 2024, 5, 3, -1),
+    ])
+    # the process dies before compacting: only the log has the changes
+    assert not (tmp_path / 'selected_days' / '2024-05.col').exists()
+    with open(store.log_path, mode='a', encoding='utf-8') as file:
+        file.write('2024,5,9')
+
+    reopened = AttendanceStore(path)
+
+    assert reopened.day_counts('alice', 2024, 5) == {3: 1}
+    assert reopened.day_counts('bob', 2024, 5) == {4: 1}
+    assert reopened.day_counts('alice', 2024, 6) == {1: 1}
+    assert not reopened.log_path.exists()
+    assert (tmp_path / 'selected_days' / '2024-05.col').exists()
+
+
+def test_log_replay_is_idempotent(tmp_path):
+    path = tmp_path / 'selected_days.csv'
+    store = AttendanceStore(path)
+    store.increment('alice', 'Alice', 'A', 2024, 5, 3, count=2)
+    saved_log = shutil.copy(store.log_path, tmp_path / 'saved.log')
+    # the partitions are written but the process dies before removing the log
+    store.close()
+    shutil.copy(saved_log, store.log_path)
+
+    assert AttendanceStore(path).day_counts('alice', 2024, 5) == {3: 2}
+
+
+def test_removed_days_are_dropped(tmp_path):
+    path = tmp_path / 'selected_days.csv'
+    store = AttendanceStore(path)
+    store.increment('alice', 'Alice', 'A', 2024, 5, 3)
+    store.increment('alice', 'Alice', 'A', 2024, 5, 3, count=-1)
+    store.close()
+
+    reopened = AttendanceStore(path)
+    assert reopened.day_counts('alice', 2024, 5) == {}
+    assert reopened.row_count() == 0
+    assert not (tmp_path / 'selected_days' / '2024-05.col').exists()
+
+
+def test_stream_does_not_compact(tmp_path):
+    path = tmp_path / 'selected_days.csv'
+    write_csv(path, [[2024, 5, 3, 2, 'alice', 'Alice', 'A'], [2024, 6, 1, 1, 'bob', 'Bob', 'B']])
+    store = AttendanceStore(path)
+    store.increment('bob', 'Bob', 'B', 2024, 5, 1)
+    store.increment('alice', 'Alice', 'A', 2024, 7, 2)
+    partition = tmp_path / 'selected_days' / '2024-05.col'
+    written = partition.stat().st_mtime_ns
+
+    rows = list(store.stream(all_tutors=True))
+
+    assert partition.stat().st_mtime_ns == written
+    assert store.log_path.exists()
+    assert list(store.stream('bob')) == [[2024, 5, 1, 1, 'bob', 'Bob', 'B'], [2024, 6, 1, 1, 'bob', 'Bob', 'B']]
+    store.compact()
+    assert list(store.stream(all_tutors=True)) == rows == [
+        [2024, 5, 3, 2, 'alice', 'Alice', 'A'],
+        [2024, 5, 1, 1, 'bob', 'Bob', 'B'],
+        [2024, 6, 1, 1, 'bob', 'Bob', 'B'],
+        [2024, 7, 2, 1, 'alice', 'Alice', 'A'],
+    ]
+
+
+@pytest.mark.parametrize('backend', ['csv', 'sqlite'])
+def test_tutors_without_username_are_kept_apart(tmp_path, backend):
+    store, _ = open_storage(backend, tmp_path / 'selected_days.csv', tmp_path / 'crypto_addresses.csv',
+                            tmp_path / 'cointutor.db')
+    alice, bob = tutor_key(1, None), tutor_key(2, None)
+    store.increment(alice, 'Alice', 'A', 2024, 5, 3)
+    store.increment(bob, 'Bob', 'B', 2024, 5, 5)
+
+    assert alice != bob
+    assert store.day_counts(alice, 2024, 5) == {3: 1}
+    assert store.day_counts(bob, 2024, 5) == {5: 1}
+    assert [total[:4] for total in store.month_totals(2024, 5)] == [(alice, 'Alice', 'A', 1), (bob, 'Bob', 'B', 1)]
+    assert list(store.stream(bob)) == [[2024, 5, 5, 1, bob, 'Bob', 'B']]
+    with pytest.raises(ValueError):
+        list(store.stream(None))
+    store.close()